@@ -2,53 +2,19 @@
 # load required modules 
 #----------------------------------------------------------------------------#
 
-import ultralytics
-from ultralytics import YOLO
-import os
-import cv2
-from ultralytics import YOLO
-import numpy as np
-import torch
-import time
+from species import load_species_table
+from prediction_engine import predict_tiles
 
 #----------------------------------------------------------------------------#
-# load model
+# settings
 #----------------------------------------------------------------------------#
 
-path_to_tiles="/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/"
-model = YOLO("/zenodo/CBarrasso/UAV_SegetalFlora/models/Anchusa_arvensis/best.pt")
+path_to_tiles = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/"
+path_to_predictions = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/"
+species_table = load_species_table(select=['Anchusa'])
 
 #----------------------------------------------------------------------------#
 # model predict
 #----------------------------------------------------------------------------#
 
-start = time.time()
-results = model.predict(source=path_to_tiles, imgsz=864, conf=0.187, save=True, save_txt=False, stream=True)
-end = time.time()
-print("The time of execution of above program is :",(end-start) * 10**3, "ms")
-
-#----------------------------------------------------------------------------#
-# save predictions
-#----------------------------------------------------------------------------#
-
-for result in results:
-
-  if result.masks == None:
-   pass
-  
-  try:
-    masks = result.masks.data
-    boxes = result.boxes.data
-    clss = boxes[:, 5]
-    species_indices = torch.where(clss == 0)
-    species_masks = masks[species_indices]
-    species_mask = torch.any(species_masks, dim=0).int() * 255
-    name = result.path
-    cv2.imwrite('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Anchusa/Anchusa_'+name.split('/')[7]+'.jpg', species_mask.cpu().numpy())
-  except:
-    pass
-
-
-
-
-
+predict_tiles(path_to_tiles, species_table, path_to_predictions, imgsz=864)
@@ -0,0 +1,167 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import csv
+import cv2
+import numpy as np
+import torch
+from profiling import StageTimer
+from species import flight_of
+from async_writer import AsyncWriter
+from prediction_engine import (list_tiles, read_tile, preprocess_tile, prefetch_map, tile_windows,
+                               load_models, MaskUnion, unpack_mask, write_prediction, close_outputs)
+from instance_records import letterbox_geometry
+
+RESOLUTION_POLICY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resolution_policy.csv')
+
+#----------------------------------------------------------------------------#
+# resolution policy: inference size and tiling per species and flight
+# height (X10/X20/X40 in the file names). A row gives imgsz and, with
+# tile > 0, windows of tile x tile image pixels overlapping by `overlap`,
+# each letterboxed to imgsz; tile 0 runs the whole image at imgsz. '*'
+# matches any species or height, the most specific row wins, and images
+# without a height in their name run at the default imgsz. Candidate
+# policies are compared by predicting the test plots with each of them
+# and scoring the folders with segmentation_accuracy.py.
+#----------------------------------------------------------------------------#
+
+def load_policy(path=RESOLUTION_POLICY):
+    policy = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            plan = (int(row['imgsz']), int(row['tile']), int(row['overlap']))
+            if plan[0] % 32 or plan[1] and not 0 <= plan[2] < plan[1]:
+                raise ValueError(f'invalid policy row {row}: imgsz must be a multiple of 32 '
+                                 'and tile larger than overlap')
+            policy[row['prefix'], row['height']] = plan
+    return policy
+
+# (imgsz, tile, overlap) for a species at a flight height
+def plan_for(policy, prefix, height, imgsz=864):
+    for key in [(prefix, height), (prefix, '*'), ('*', height), ('*', '*')]:
+        if key in policy:
+            return policy[key]
+    return (imgsz, 0, 0)
+
+# decoded tile split into one piece of work per distinct plan of its
+# species: (plan, model indexes, crops), a crop being the read and core
+# windows (col, row, width, height) and the letterboxed tensor
+def plan_tile(path, policy, prefixes, imgsz=864, timer=None):
+    timer = timer or StageTimer()
+    with timer.stage('decode', [path]):
+        img = read_tile(path)
+    _, height = flight_of(path)
+    plans = {}
+    for m, prefix in enumerate(prefixes):
+        plans.setdefault(plan_for(policy, prefix, height, imgsz), []).append(m)
+    work = []
+    with timer.stage('preprocess', [path]):
+        for (size, tile, overlap), models in plans.items():
+            if tile:
+                windows = tile_windows(img.shape[1], img.shape[0], tile, overlap)
+            else:
+                windows = [((0, 0, img.shape[1], img.shape[0]), None)]
+            crops = [(read, core, preprocess_tile(img[read[1]:read[1] + read[3], read[0]:read[0] + read[2]], size))
+                     for read, core in windows]
+            work.append(((size, tile, overlap), models, crops))
+    return path, img.shape[:2], work
+
+#----------------------------------------------------------------------------#
+# prediction
+#----------------------------------------------------------------------------#
+
+# mask of a window letterboxed to imgsz, cut to the window's core and put
+# back at image pixels
+def paste(canvas, mask, read, core, imgsz):
+    geometry = letterbox_geometry((read[3], read[2]), imgsz)
+    mask = mask[geometry['top']:geometry['top'] + geometry['height'],
+                geometry['left']:geometry['left'] + geometry['width']]
+    mask = cv2.resize(mask.view(np.uint8), (read[2], read[3]), interpolation=cv2.INTER_NEAREST)
+    top, left = core[1] - read[1], core[0] - read[0]
+    canvas[core[1]:core[1] + core[3], core[0]:core[0] + core[2]] = mask[top:top + core[3], left:left + core[2]] > 0
+
+# crops of the same plan, species and tensor shape, possibly from several
+# tiles; a tile's masks are written once its last crop is through
+def run_batch(items, models, union, path_to_predictions, mask_format, timer, writer):
+    plan, species = items[0][0]['plan'], items[0][0]['models']
+    x = torch.cat([job['crops'][i][2] for job, i in items])
+    paths = [job['path'] for job, _ in items]
+    for m in species:
+        row, model = models[m]
+        with timer.stage('inference', paths):
+            results = model.predict(source=x, imgsz=plan[0], conf=row['conf'], verbose=False)
+        for (job, i), result in zip(items, results):
+            with timer.stage('postprocess', [job['path']]):
+                packed, mask_shape = union(result)
+                read, core, _ = job['crops'][i]
+                if not plan[1]:
+                    job['masks'][m] = (packed, mask_shape)
+                elif packed is not None:
+                    paste(job['masks'][m], unpack_mask(packed, mask_shape), read, core, plan[0])
+    for job, _ in items:
+        job['remaining'] -= 1
+        if job['remaining']:
+            continue
+        with timer.stage('write wait', [job['path']]):
+            writer.submit(write_masks, timer, path_to_predictions, {m: models[m][0] for m in job['masks']},
+                          job['path'], job['shape'], job['masks'], plan[1], mask_format)
+        job['crops'] = job['masks'] = None
+
+# the species masks of a tile, run by the output stage; stitched masks are
+# packed there too
+def write_masks(timer, path_to_predictions, rows, path, shape, masks, tiled, mask_format):
+    with timer.stage('write', [path]):
+        for m, mask in masks.items():
+            if tiled:
+                mask = (np.packbits(mask) if mask.any() else None, mask.shape)
+            write_prediction(path_to_predictions, rows[m], path, *mask, mask_format, shape)
+
+# as predict_tiles, with imgsz and tiling chosen per tile and species from
+# the policy; whole-image masks keep the letterboxed grid of their imgsz,
+# tiled ones are stitched at the tile's own pixels. Crops are batched
+# across tiles by plan and shape; at most max_pending crops wait for a
+# batch to fill before the fullest one runs anyway. Masks are written by
+# write_workers background threads as in predict_tiles; there is no
+# manifest, instance records, presence screen or annotated images here
+def predict_tiles_adaptive(path_to_tiles, species_table, path_to_predictions, path_to_policy=RESOLUTION_POLICY,
+                           imgsz=864, batch_size=8, workers=4, prefetch=8, mask_format='jpg',
+                           path_to_report=None, backend='torch', write_workers=4, write_queue=64):
+    timer = StageTimer()
+    policy = load_policy(path_to_policy)
+    with timer.stage('model load'):
+        models = load_models(species_table, backend, imgsz, path_to_tiles)
+    for row in species_table:
+        os.makedirs(os.path.join(path_to_predictions, row['prefix']), exist_ok=True)
+    prefixes = [row['prefix'] for row, _ in models]
+    max_pending = 4 * batch_size
+    union = MaskUnion()
+    writer = AsyncWriter(write_workers, write_queue)
+    buckets = {}
+    tiles = prefetch_map(plan_tile, list_tiles(path_to_tiles), (policy, prefixes, imgsz, timer), workers, prefetch)
+    options = (models, union, path_to_predictions, mask_format, timer, writer)
+    try:
+        for path, shape, work in tiles:
+            for plan, species, crops in work:
+                job = {'path': path, 'shape': shape, 'plan': plan, 'models': species, 'crops': crops,
+                       'remaining': len(crops),
+                       'masks': {m: np.zeros(shape, dtype=bool) for m in species} if plan[1] else {}}
+                for i, (_, _, tensor) in enumerate(crops):
+                    key = (plan, tuple(species), tuple(tensor.shape))
+                    buckets.setdefault(key, []).append((job, i))
+                    if len(buckets[key]) == batch_size:
+                        run_batch(buckets.pop(key), *options)
+                while sum(map(len, buckets.values())) > max_pending:
+                    key = max(buckets, key=lambda key: len(buckets[key]))
+                    run_batch(buckets.pop(key), *options)
+        for items in buckets.values():
+            run_batch(items, *options)
+    except BaseException:
+        close_outputs(writer, failing=True)
+        raise
+    close_outputs(writer)
+    print(timer.summary())
+    if path_to_report:
+        timer.write(path_to_report)
+    return timer.report()
@@ -0,0 +1,47 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#----------------------------------------------------------------------------#
+# background output stage: writes run on a pool of threads, at most
+# `queue_size` of them pending, so the inference loop only blocks when
+# storage falls that far behind (backpressure instead of unbounded memory);
+# failures are collected and raised together by close(), once everything
+# else has been written. With workers=0 writes run inline.
+#----------------------------------------------------------------------------#
+
+class AsyncWriter:
+
+    def __init__(self, workers=4, queue_size=64):
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.written = 0
+
+    def submit(self, function, *args):
+        if self.pool is None:
+            return self._run(function, args)
+        self.slots.acquire()
+        self.pool.submit(self._run, function, args).add_done_callback(lambda _: self.slots.release())
+
+    def _run(self, function, args):
+        try:
+            function(*args)
+        except Exception as error:
+            with self.lock:
+                self.errors.append(error)
+        else:
+            with self.lock:
+                self.written += 1
+
+    # waits for the pending writes
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        if self.errors:
+            raise IOError(f'{len(self.errors)} of {len(self.errors) + self.written} writes failed, '
+                          f'first: {self.errors[0]!r}')
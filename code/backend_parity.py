@@ -0,0 +1,93 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import sys
+import glob
+import pandas as pd
+from species import load_species_table
+from prediction_engine import predict_tiles
+from segmentation_accuracy import confusion_counts, metrics_from_counts, run_evaluation, ACCURACY_COLUMNS
+from mask_format import read_mask
+
+#----------------------------------------------------------------------------#
+# settings: accuracy of the ONNX backends against the PyTorch (FP32) models
+# on the annotated test plots, per species
+#----------------------------------------------------------------------------#
+
+path_to_tiles = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/"
+path_to_masks = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/"
+path_to_parity = "/zenodo/CBarrasso/UAV_SegetalFlora/data/backend_parity/"  # one prediction folder per backend
+path_to_calibration = None   # tiles calibrating onnx-int8, path_to_tiles if None
+path_to_output = "/zenodo/CBarrasso/UAV_SegetalFlora/data/backend_parity.csv"
+species_table = load_species_table()
+backends = ['torch', 'onnx', 'onnx-int8']   # the first one is the reference
+max_iou_drop = 0.01          # mean IoU a backend may lose against the reference
+workers = os.cpu_count()
+
+#----------------------------------------------------------------------------#
+# functions
+#----------------------------------------------------------------------------#
+
+# pooled confusion counts of a backend's masks against the reference masks
+# of the same tiles: agreement IoU 1 means identical predictions
+def agreement(species_table, path_to_reference, path_to_backend):
+    d = []
+    for row in species_table:
+        counts = [0, 0, 0, 0]
+        for reference in sorted(glob.glob(os.path.join(path_to_reference, row['prefix'], '*.sfm'))):
+            prediction = os.path.join(path_to_backend, row['prefix'], os.path.basename(reference))
+            counts = [a + b for a, b in zip(counts, confusion_counts(read_mask(prediction), read_mask(reference)))]
+        metrics = metrics_from_counts(*counts)
+        d.append({'species': row['species'], 'agreement_IoU': metrics['IoU']})
+    return pd.DataFrame(d)
+
+# predictions of every backend as .sfm masks, scored with the metrics of
+# segmentation_accuracy.py; one row per species and backend with the mean
+# metrics over plots and heights, their change against the reference
+# backend, the agreement with its masks, the throughput and p50 latency
+# over the tiles and the model load time (ONNX files are exported and
+# quantized before the timed run, so neither counts against the backend)
+def backend_parity(species_table, backends, path_to_tiles, path_to_masks, path_to_parity,
+                   path_to_calibration=None, workers=None):
+    frames = []
+    for backend in backends:
+        path_to_predictions = os.path.join(path_to_parity, backend)
+        if backend != 'torch':
+            from onnx_backend import model_file  # optional dependency, only needed for the onnx backends
+            for row in species_table:
+                model_file(row['model'], backend, 864, path_to_calibration or path_to_tiles)
+        report = predict_tiles(path_to_tiles, species_table, path_to_predictions, save_annotated=False,
+                               mask_format='sfm', backend=backend, path_to_calibration=path_to_calibration)
+        accuracy = pd.DataFrame(run_evaluation(species_table, path_to_predictions, path_to_masks, workers),
+                                columns=ACCURACY_COLUMNS)
+        frame = accuracy.groupby('species', sort=False)[['IoU', 'precision', 'recall']].mean().reset_index()
+        frame = frame.merge(agreement(species_table, os.path.join(path_to_parity, backends[0]),
+                                      path_to_predictions), on='species')
+        frame.insert(1, 'backend', backend)
+        frame['images_s'] = report['throughput_images_s']
+        frame['latency_p50_ms'] = report['latency_ms']['p50']
+        frame['model_load_s'] = report['model_load_s']
+        frames.append(frame)
+    result = pd.concat(frames, ignore_index=True)
+    reference = result[result['backend'] == backends[0]].set_index('species')
+    for metric in ['IoU', 'precision', 'recall']:
+        result['delta_' + metric] = result[metric] - result['species'].map(reference[metric])
+    result['speedup'] = result['images_s'] / reference['images_s'].iloc[0]
+    return result
+
+#----------------------------------------------------------------------------#
+# run: exits with 1 if any backend loses more than max_iou_drop mean IoU on
+# any species
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    result = backend_parity(species_table, backends, path_to_tiles, path_to_masks, path_to_parity,
+                            path_to_calibration, workers)
+    result.to_csv(path_to_output, index=False)
+    print(result.to_string(index=False, float_format='%.4f'))
+    failed = result[result['delta_IoU'] < -max_iou_drop]
+    for _, row in failed.iterrows():
+        print(f"{row['backend']}: {row['species']} IoU {row['delta_IoU']:+.4f} against {backends[0]}")
+    sys.exit(1 if len(failed) else 0)
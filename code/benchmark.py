@@ -0,0 +1,162 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import sys
+import json
+import time
+import tempfile
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from ultralytics import YOLO
+from ultralytics.engine.results import Results
+from species import load_species_table
+from prediction_engine import predict_tiles, MaskUnion
+from segmentation_accuracy import compute_metrics, run_evaluation
+
+#----------------------------------------------------------------------------#
+# settings: offline benchmark on synthetic plots and a randomly initialised
+# model, compared against the stored baseline
+#----------------------------------------------------------------------------#
+
+path_to_benchmark = None   # working folder, a temporary one if None
+path_to_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+update_baseline = False    # store this run as the new baseline
+tolerance = 0.2            # relative slow-down that counts as a regression
+plots = 6                  # synthetic test plots, each flown at 10, 20 and 40 m
+plot_size = (1200, 1600)   # pixels of a plot at 10 m; 20 and 40 m halve the GSD
+species = 2                # species models run over every tile
+conf = 0.001
+instances = 50             # instance masks per tile in the post-processing benchmark
+batch_size = 8
+workers = 4
+seed = 0
+
+HEIGHTS = {'10': 1, '20': 2, '40': 4}
+HIGHER_IS_BETTER = {'inference_images_s'}
+
+#----------------------------------------------------------------------------#
+# synthetic data
+#----------------------------------------------------------------------------#
+
+def random_blobs(rng, shape, count=40):
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(count):
+        centre = (int(rng.integers(shape[1])), int(rng.integers(shape[0])))
+        cv2.circle(mask, centre, int(rng.integers(5, shape[0] // 20)), 250, -1)
+    return mask
+
+# RGB tiles named as the study flights (plot_<n>_flight_X10/X20/X40.png),
+# a ground-truth mask per plot and species at 10 m and a perturbed copy of
+# it per height standing in for the predictions to evaluate
+def make_dataset(root, species_table, plots, plot_size, seed=0):
+    rng = np.random.default_rng(seed)
+    tiles = os.path.join(root, 'test_plots')
+    os.makedirs(tiles, exist_ok=True)
+    for plot in range(1, plots + 1):
+        for height, factor in HEIGHTS.items():
+            shape = (plot_size[0] // factor, plot_size[1] // factor)
+            img = rng.integers(0, 256, shape + (3,), dtype=np.uint8)
+            cv2.imwrite(os.path.join(tiles, f'plot_{plot}_flight_X{height}.png'), cv2.blur(img, (9, 9)))
+        for row in species_table:
+            for folder in ['masks', 'predictions']:
+                os.makedirs(os.path.join(root, folder, row['prefix']), exist_ok=True)
+            ground_truth = random_blobs(rng, plot_size)
+            Image.fromarray(ground_truth).save(os.path.join(root, 'masks', row['prefix'], f'plot_{plot}_flight_X10.tiff'))
+            for height, factor in HEIGHTS.items():
+                shape = (plot_size[0] // factor, plot_size[1] // factor)
+                prediction = cv2.resize(ground_truth, shape[::-1], interpolation=cv2.INTER_NEAREST)
+                prediction[rng.random(shape) < 0.02] = 250
+                name = f"{row['prefix']}_plot_{plot}_flight_X{height}.png.tiff"
+                Image.fromarray(prediction).save(os.path.join(root, 'predictions', row['prefix'], name))
+    return tiles
+
+def random_model(path, seed=0):
+    torch.manual_seed(seed)
+    model = YOLO('yolov8n-seg.yaml')
+    model.save(path)
+    return path
+
+# a random model rarely passes any threshold, so the mask union is timed on
+# a synthetic result with a fixed number of instances of the species
+def random_result(rng, instances, shape=(864, 864), classes=1):
+    masks = torch.from_numpy(rng.random((instances,) + shape, dtype=np.float32) < 0.01).float()
+    boxes = torch.zeros((instances, 6))
+    boxes[:, 4] = 0.5
+    boxes[:, 5] = torch.from_numpy(rng.integers(0, classes, instances)).float()
+    return Results(np.zeros(shape + (3,), dtype=np.uint8), path='', names=dict(enumerate(['species', 'other'])),
+                   boxes=boxes, masks=masks)
+
+def time_call(function, *args, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (time.perf_counter() - start) / repeat
+
+#----------------------------------------------------------------------------#
+# benchmark
+#----------------------------------------------------------------------------#
+
+def run_benchmark(root):
+    os.makedirs(root, exist_ok=True)
+    table = load_species_table()[:species]
+    model = random_model(os.path.join(root, 'random.pt'), seed)
+    table = [dict(row, model=model, conf=conf) for row in table]
+    tiles = make_dataset(root, table, plots, plot_size, seed)
+
+    report = predict_tiles(tiles, table, os.path.join(root, 'output'), batch_size=batch_size,
+                           workers=workers, save_annotated=False)
+
+    start = time.perf_counter()
+    run_evaluation(table, os.path.join(root, 'predictions'), os.path.join(root, 'masks'), workers)
+    evaluation = time.perf_counter() - start
+
+    rng = np.random.default_rng(seed)
+    postprocess = time_call(MaskUnion(), random_result(rng, instances))
+    y_true = rng.random((4000, 5000)) < 0.1
+    y_pred = rng.random((4000, 5000)) < 0.1
+    metrics = time_call(compute_metrics, y_pred, y_true)
+
+    return {
+        'inference_images_s': report['throughput_images_s'],
+        'inference_latency_p95_ms': report['latency_ms']['p95'],
+        'model_load_s': report['model_load_s'],
+        'postprocess_ms': postprocess * 1e3,
+        'evaluation_s': evaluation,
+        'metrics_20mp_ms': metrics * 1e3,
+        }
+
+# throughput must not drop, everything else must not grow, by more than
+# the tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'metric':<28}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key, value in results.items():
+        if key not in baseline:
+            print(f'{key:<28}{"":>12}{value:12.2f}')
+            continue
+        change = value / baseline[key] - 1
+        worse = -change if key in HIGHER_IS_BETTER else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        print(f'{key:<28}{baseline[key]:12.2f}{value:12.2f}{change:+10.1%}{flag}')
+        if flag:
+            regressions.append(key)
+    return regressions
+
+#----------------------------------------------------------------------------#
+# run
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    root = path_to_benchmark or tempfile.mkdtemp(prefix='segflora_benchmark_')
+    results = run_benchmark(root)
+    if update_baseline or not os.path.exists(path_to_baseline):
+        with open(path_to_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('baseline written to ' + path_to_baseline)
+    with open(path_to_baseline) as f:
+        regressions = compare(results, json.load(f), tolerance)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,178 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import math
+import warnings
+import xml.etree.ElementTree as ET
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from rasterio.errors import NotGeoreferencedWarning
+from mask_format import mask_window
+
+#----------------------------------------------------------------------------#
+# georeferenced mask rasters: Cloud-Optimized GeoTIFFs (internally tiled,
+# deflate-compressed 0/255 masks, with overviews) that GIS clients read by
+# window and zoom level; all-zero blocks of sparse masks compress to almost
+# nothing. Overviews average the mask, so at coarse zoom levels a pixel
+# shows the species cover of the area it spans (0-255).
+#----------------------------------------------------------------------------#
+
+PROFILE = {'driver': 'COG', 'dtype': 'uint8', 'count': 1, 'compress': 'deflate', 'blocksize': 256,
+           'overview_resampling': 'average', 'BIGTIFF': 'IF_SAFER'}
+
+#----------------------------------------------------------------------------#
+# georeference of a source image: its own transform and CRS (GeoTIFF), else
+# a world file next to it (.pgw/.pngw/.wld for .png, .jgw/.jpgw for .jpg,
+# ...); the CRS, if the image has none, from a .prj next to it, else crs
+#----------------------------------------------------------------------------#
+
+def world_file(path):
+    base, ext = os.path.splitext(path)
+    ext = ext[1:]
+    for suffix in [ext[:1] + ext[-1:] + 'w', ext + 'w', 'wld']:
+        for candidate in [base + '.' + suffix, base + '.' + suffix.upper()]:
+            if os.path.exists(candidate):
+                return candidate
+    return None
+
+# lines A, D, B, E, C, F, with C, F the centre of the top-left pixel
+def read_world_file(path):
+    with open(path) as f:
+        a, d, b, e, c, f = (float(value) for value in f.read().split()[:6])
+    return Affine(a, b, c - a / 2 - b / 2, d, e, f - d / 2 - e / 2)
+
+def read_prj(path):
+    prj = os.path.splitext(path)[0] + '.prj'
+    if not os.path.exists(prj):
+        return None
+    with open(prj) as f:
+        return CRS.from_wkt(f.read())
+
+# (height, width), transform (None if the image has no georeference) and CRS
+def source_georeference(path, crs=None):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(path) as src:
+            shape, transform, source_crs = (src.height, src.width), src.transform, src.crs
+    if transform.is_identity:
+        sidecar = world_file(path)
+        transform = read_world_file(sidecar) if sidecar else None
+    return shape, transform, source_crs or read_prj(path) or (CRS.from_user_input(crs) if crs else None)
+
+#----------------------------------------------------------------------------#
+# single images: the mask of one tile as a COG with the tile's footprint,
+# overviews built by the COG driver as the tile is written
+#----------------------------------------------------------------------------#
+
+def write_geotiff(path, mask, tile_path, crs=None, **tags):
+    source_shape, transform, crs = source_georeference(tile_path, crs)
+    top, left, height, width = mask_window(source_shape, mask.shape)
+    mask = np.asarray(mask)[top:top + height, left:left + width] > 0
+    profile = dict(PROFILE, width=width, height=height)
+    if transform is not None:
+        profile.update(transform=transform * Affine.scale(source_shape[1] / width, source_shape[0] / height), crs=crs)
+    tmp = path + '.tmp.tif'
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(tmp, 'w', **profile) as dst:
+            dst.write(mask.view(np.uint8) * np.uint8(255), 1)
+            dst.update_tags(**{key: str(value) for key, value in tags.items()})
+    os.replace(tmp, path)
+    return path
+
+#----------------------------------------------------------------------------#
+# mosaics: written window by window into a tiled GeoTIFF; every window is
+# also added to one count raster per overview level (foreground pixels per
+# overview pixel, summed over the windows touching it), so overviews never
+# need a second pass over the full-resolution mask. close() scales the
+# counts to mean cover and copies mask and overviews into the COG
+#----------------------------------------------------------------------------#
+
+def overview_factors(width, height, blocksize=256):
+    factors = []
+    while max(math.ceil(width / 2 ** len(factors)), math.ceil(height / 2 ** len(factors))) > blocksize:
+        factors.append(2 ** (len(factors) + 1))
+    return factors
+
+class MosaicGeoTIFF:
+
+    def __init__(self, path, width, height, transform=None, crs=None, blocksize=256, **tags):
+        self.path = path
+        self.width, self.height = width, height
+        self.blocksize = blocksize
+        self.tags = {key: str(value) for key, value in tags.items()}
+        profile = {'driver': 'GTiff', 'count': 1, 'width': width, 'height': height, 'tiled': True,
+                   'blockxsize': blocksize, 'blockysize': blocksize, 'compress': 'deflate', 'BIGTIFF': 'IF_SAFER'}
+        if transform is not None:
+            profile.update(transform=transform, crs=crs)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            self.full = rasterio.open(path + '.full.tif', 'w', dtype='uint8', **profile)
+            self.levels = [(factor, rasterio.open(f'{path}.counts{factor}.tif', 'w+', dtype='uint32',
+                                                  **dict(profile, width=math.ceil(width / factor),
+                                                         height=math.ceil(height / factor))))
+                           for factor in overview_factors(width, height, blocksize)]
+
+    # mask (bool or 0/255) of a window; windows must not overlap
+    def write(self, mask, window):
+        mask = np.asarray(mask) > 0
+        self.full.write(mask.view(np.uint8) * np.uint8(255), 1, window=window)
+        for factor, counts in self.levels:
+            row0, col0 = window.row_off // factor, window.col_off // factor
+            row1 = math.ceil((window.row_off + window.height) / factor)
+            col1 = math.ceil((window.col_off + window.width) / factor)
+            frame = np.zeros(((row1 - row0) * factor, (col1 - col0) * factor), dtype=bool)
+            top, left = window.row_off - row0 * factor, window.col_off - col0 * factor
+            frame[top:top + window.height, left:left + window.width] = mask
+            block = frame.reshape(row1 - row0, factor, col1 - col0, factor).sum((1, 3), dtype=np.uint32)
+            target = Window(col0, row0, col1 - col0, row1 - row0)
+            counts.write(counts.read(1, window=target) + block, 1, window=target)
+
+    # counts to 0-255 mean cover, edge pixels divided by the pixels they span
+    def _cover(self, factor, counts, path):
+        rows = np.minimum(factor, self.height - np.arange(counts.height) * factor)
+        cols = np.minimum(factor, self.width - np.arange(counts.width) * factor)
+        with rasterio.open(path, 'w', **dict(counts.profile, dtype='uint8')) as dst:
+            for row0 in range(0, counts.height, self.blocksize):
+                window = Window(0, row0, counts.width, min(self.blocksize, counts.height - row0))
+                count = counts.read(1, window=window).astype(np.float64)
+                pixels = np.outer(rows[row0:row0 + window.height], cols)
+                dst.write(np.rint(255 * count / pixels).astype(np.uint8), 1, window=window)
+
+    def close(self):
+        self.full.close()
+        sources = [self.path + '.full.tif']
+        for factor, counts in self.levels:
+            sources.append(f'{self.path}.overview{factor}.tif')
+            self._cover(factor, counts, sources[-1])
+            counts.close()
+        vrt = self.path + '.vrt'
+        dataset = ET.Element('VRTDataset', rasterXSize=str(self.width), rasterYSize=str(self.height))
+        with rasterio.open(sources[0]) as full:
+            if full.crs:
+                ET.SubElement(dataset, 'SRS').text = full.crs.to_wkt()
+            if not full.transform.is_identity:
+                ET.SubElement(dataset, 'GeoTransform').text = ', '.join(map(repr, full.transform.to_gdal()))
+        metadata = ET.SubElement(dataset, 'Metadata')
+        for key, value in self.tags.items():
+            ET.SubElement(metadata, 'MDI', key=key).text = value
+        band = ET.SubElement(dataset, 'VRTRasterBand', dataType='Byte', band='1')
+        for i, source in enumerate(sources):
+            element = ET.SubElement(band, 'SimpleSource' if i == 0 else 'Overview')
+            ET.SubElement(element, 'SourceFilename', relativeToVRT='0').text = os.path.abspath(source)
+            ET.SubElement(element, 'SourceBand').text = '1'
+        ET.ElementTree(dataset).write(vrt)
+        tmp = self.path + '.tmp.tif'
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            rasterio.shutil.copy(vrt, tmp, driver='COG', compress='deflate', blocksize=self.blocksize,
+                                 overviews='FORCE_USE_EXISTING' if self.levels else 'NONE', BIGTIFF='IF_SAFER')
+        os.replace(tmp, self.path)
+        for path in [vrt] + sources + [f'{self.path}.counts{factor}.tif' for factor, _ in self.levels]:
+            os.remove(path)
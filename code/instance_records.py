@@ -0,0 +1,134 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import time
+import numpy as np
+import torch
+from species import flight_of
+from mask_format import letterbox_geometry
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+def packed_count(packed):
+    return 0 if packed is None else int(POPCOUNT[packed].sum())
+
+#----------------------------------------------------------------------------#
+# per-instance records and per-plot aggregates, computed on the device from
+# result.masks/result.boxes while predicting and streamed to Parquet
+#----------------------------------------------------------------------------#
+
+INSTANCE_COLUMNS = ['tile', 'plot', 'height', 'species', 'class', 'conf', 'x1', 'y1', 'x2', 'y2',
+                    'area_px', 'centroid_x', 'centroid_y']
+PLOT_COLUMNS = ['tile', 'plot', 'height', 'species', 'instances', 'cover_px', 'image_px', 'cover_percent']
+
+# boxes, areas and centroids in pixels of the original image
+def instance_table(result, geometry):
+    if result is None or result.masks is None:
+        return {name: np.zeros(0) for name in ['class', 'conf', 'x1', 'y1', 'x2', 'y2', 'area_px',
+                                               'centroid_x', 'centroid_y']}
+    masks = result.masks.data
+    rows = masks.sum(2, dtype=torch.float32)
+    cols = masks.sum(1, dtype=torch.float32)
+    area = rows.sum(1)
+    y = torch.arange(masks.shape[1], device=masks.device, dtype=torch.float32)
+    x = torch.arange(masks.shape[2], device=masks.device, dtype=torch.float32)
+    centroid_y = (rows @ y) / area.clamp(min=1)
+    centroid_x = (cols @ x) / area.clamp(min=1)
+    boxes = result.boxes.data
+    ratio, left, top = geometry['ratio'], geometry['left'], geometry['top']
+    return {
+        'class': boxes[:, 5].cpu().numpy().astype(np.int16),
+        'conf': boxes[:, 4].cpu().numpy().astype(np.float32),
+        'x1': ((boxes[:, 0] - left) / ratio).cpu().numpy().astype(np.float32),
+        'y1': ((boxes[:, 1] - top) / ratio).cpu().numpy().astype(np.float32),
+        'x2': ((boxes[:, 2] - left) / ratio).cpu().numpy().astype(np.float32),
+        'y2': ((boxes[:, 3] - top) / ratio).cpu().numpy().astype(np.float32),
+        'area_px': (area / ratio ** 2).cpu().numpy().round().astype(np.int64),
+        'centroid_x': ((centroid_x - left) / ratio).cpu().numpy().astype(np.float32),
+        'centroid_y': ((centroid_y - top) / ratio).cpu().numpy().astype(np.float32),
+        }
+
+def plots_path(path_to_instances):
+    return path_to_instances.rsplit('.', 1)[0] + '_plots.parquet'
+
+# records are never overwritten: a run resumed from the manifest only
+# predicts the tiles left, so when path_to_instances exists the run writes
+# <name>_part<time>.parquet next to it; readers take the records of a tile
+# and species from the newest file predicting it (plant_index.read_instances)
+def part_path(path_to_instances):
+    path = path_to_instances
+    base, ext = os.path.splitext(path_to_instances)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    for i in range(1000):
+        if not os.path.exists(path) and not os.path.exists(plots_path(path)):
+            return path
+        path = f'{base}_part{stamp}{"-" + str(i) if i else ""}{ext}'
+    raise FileExistsError(path)
+
+class InstanceWriter:
+
+    # instances go to path_to_instances (or a new part next to it, see
+    # part_path), one aggregate row per tile and species to
+    # <name>_plots.parquet next to it; rows are buffered and written as a
+    # row group every `rows` instances
+    def __init__(self, path_to_instances, rows=65536):
+        import pyarrow as pa  # optional dependency, only needed for instance records
+        import pyarrow.parquet as pq
+        self.pa = pa
+        text = [(name, pa.string()) for name in ['tile', 'plot', 'height', 'species']]
+        self.schemas = {
+            'instances': pa.schema(text + [('class', pa.int16()), ('conf', pa.float32())]
+                                   + [(name, pa.float32()) for name in ['x1', 'y1', 'x2', 'y2']]
+                                   + [('area_px', pa.int64()), ('centroid_x', pa.float32()), ('centroid_y', pa.float32())]),
+            'plots': pa.schema(text + [('instances', pa.int32()), ('cover_px', pa.int64()), ('image_px', pa.int64()),
+                                       ('cover_percent', pa.float64())]),
+            }
+        self.path = part_path(path_to_instances)
+        self.writers = {'instances': pq.ParquetWriter(self.path, self.schemas['instances']),
+                        'plots': pq.ParquetWriter(plots_path(self.path), self.schemas['plots'])}
+        self.rows = rows
+        self.instances = []
+        self.plots = []
+        self.buffered = 0
+
+    # tiles skipped by the presence screen: a plot row without instances
+    def add_empty(self, tile_path, row, geometry):
+        self.add(tile_path, row, None, None, geometry)
+
+    def add(self, tile_path, row, result, packed, geometry):
+        plot, height = flight_of(tile_path)
+        keys = {'tile': tile_path, 'plot': plot, 'height': height, 'species': row['species']}
+        table = instance_table(result, geometry)
+        species = table['class'] == 0
+        count = int(species.sum())
+        if count:
+            chunk = {name: np.full(count, value, dtype=object) for name, value in keys.items()}
+            chunk.update({name: values[species] for name, values in table.items()})
+            self.instances.append(chunk)
+            self.buffered += count
+        cover = packed_count(packed)
+        image = geometry['width'] * geometry['height']
+        self.plots.append(dict(keys, instances=count, cover_px=round(cover / geometry['ratio'] ** 2),
+                               image_px=round(image / geometry['ratio'] ** 2), cover_percent=100 * cover / image))
+        if self.buffered >= self.rows:
+            self.flush()
+
+    def flush(self):
+        if self.instances:
+            columns = {name: np.concatenate([chunk[name] for chunk in self.instances]) for name in INSTANCE_COLUMNS}
+            self._write('instances', columns)
+        if self.plots:
+            self._write('plots', {name: [plot[name] for plot in self.plots] for name in PLOT_COLUMNS})
+        self.instances, self.plots, self.buffered = [], [], 0
+
+    def _write(self, key, columns):
+        schema = self.schemas[key]
+        arrays = [self.pa.array(columns[field.name], type=field.type) for field in schema]
+        self.writers[key].write_table(self.pa.Table.from_arrays(arrays, schema=schema))
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
@@ -0,0 +1,102 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import glob
+import json
+import hashlib
+import threading
+
+#----------------------------------------------------------------------------#
+# prediction manifest: one JSON line per finished (tile, species) prediction,
+# keyed by the tile name and content hash, the species, the model weights
+# hash, imgsz, conf and output format, appended once its outputs are
+# written; reruns skip the keys already present whose outputs still exist,
+# and any change of tile, weights or threshold gives a new key, so stale
+# outputs are recomputed
+#----------------------------------------------------------------------------#
+
+def sha256_file(path, chunk=2**20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class Manifest:
+
+    # with shard, lines are appended to <name>.shard<shard>.jsonl instead, so
+    # several processes can record into one manifest; shard files are read
+    # along with the manifest and merged into it when it is opened without
+    def __init__(self, path, shard=None):
+        self.path = path
+        self.entries = {}
+        self.digests = {}
+        self.lock = threading.Lock()  # outputs are recorded from the writer threads
+        stem = os.path.splitext(path)[0]
+        shards = sorted(glob.glob(glob.escape(stem) + '.shard*.jsonl'))
+        for part in [path] + shards:
+            if os.path.exists(part):
+                self._load(part)
+        if shard is not None:
+            self.log = open(f'{stem}.shard{shard}.jsonl', 'a')
+            return
+        if os.path.exists(path) or shards:
+            self._compact()
+            for part in shards:
+                os.remove(part)
+        self.log = open(path, 'a')
+
+    def _load(self, path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # line cut short by a crash
+                if 'digest' in record:
+                    self.digests[record['path']] = record
+                else:
+                    self.entries[record['key']] = record
+
+    # rewrite without superseded lines, atomically
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for record in list(self.digests.values()) + list(self.entries.values()):
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp, self.path)
+
+    def _append(self, record):
+        with self.lock:
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+
+    # content hash, recomputed only when size or modification time changed
+    def digest(self, path):
+        stat = os.stat(path)
+        cached = self.digests.get(path)
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['digest']
+        record = {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': sha256_file(path)}
+        self.digests[path] = record
+        self._append(record)
+        return record['digest']
+
+    @staticmethod
+    def key(tile, tile_digest, species, weights_digest, imgsz, conf, mask_format):
+        key = f'{os.path.basename(tile)}:{tile_digest}:{species}:{weights_digest}:{imgsz}:{conf}:{mask_format}'
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def done(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and all(os.path.exists(path) for path in entry['outputs'])
+
+    def record(self, key, tile, species, outputs):
+        entry = {'key': key, 'tile': tile, 'species': species, 'outputs': outputs}
+        self.entries[key] = entry
+        self._append(entry)
+
+    def close(self):
+        self.log.close()
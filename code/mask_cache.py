@@ -0,0 +1,110 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import hashlib
+import collections
+import numpy as np
+from PIL import Image
+from mask_format import unpack_rows
+
+#----------------------------------------------------------------------------#
+# ground-truth mask cache: every mask is decoded once, kept bit-packed and
+# resampled (nearest neighbour) to the pixel grid of each altitude's
+# prediction; entries are evicted least-recently-used beyond max_bytes
+#----------------------------------------------------------------------------#
+
+def read_binary_mask(path):
+    mask = np.asarray(Image.open(path)) > 0
+    return mask.any(axis=-1) if mask.ndim == 3 else mask
+
+# (height, width) from the file header, without decoding the pixels
+def native_shape(path):
+    with Image.open(path) as img:
+        return img.size[::-1]
+
+def resample_nearest(mask, shape):
+    if mask.shape == tuple(shape):
+        return mask
+    rows = ((np.arange(shape[0]) + 0.5) * mask.shape[0] / shape[0]).astype(np.intp)
+    cols = ((np.arange(shape[1]) + 0.5) * mask.shape[1] / shape[1]).astype(np.intp)
+    return mask[rows[:, None], cols]
+
+class GroundTruthCache:
+
+    def __init__(self, max_bytes=256 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # bool mask of the ground truth at path on the given (height, width) grid,
+    # on its native grid if shape is None
+    def get(self, path, shape=None):
+        shape = tuple(shape) if shape is not None else native_shape(path)
+        packed = self._lookup(path, shape)
+        return np.unpackbits(packed, count=shape[0] * shape[1]).view(bool).reshape(shape)
+
+    # rows start:stop only, unpacked from the cached (possibly memory-mapped)
+    # bits without materialising the whole mask
+    def rows(self, path, shape, start, stop):
+        return unpack_rows(self._lookup(path, tuple(shape)), shape, start, stop)
+
+    # resampled versions for all prediction grids of one plot in one go
+    def precompute(self, path, shapes):
+        for shape in shapes:
+            self._lookup(path, tuple(shape))
+
+    def _lookup(self, path, shape):
+        key = (path, shape)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        packed = self._load(path, shape)
+        if packed is None:
+            if shape == native_shape(path):
+                mask = read_binary_mask(path)
+            else:
+                mask = resample_nearest(self.get(path), shape)
+            packed = self._store(path, mask)
+        self.entries[key] = packed
+        self.nbytes += packed.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return packed
+
+    #------------------------------------------------------------------------#
+    # optional on-disk copy, memory-mapped on load and shared between
+    # processes and runs
+    #------------------------------------------------------------------------#
+
+    def _disk_path(self, path, shape):
+        stat = os.stat(path)
+        key = f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+        return os.path.join(self.cache_dir, f'{hashlib.sha1(key.encode()).hexdigest()}_{shape[0]}x{shape[1]}.npy')
+
+    def _load(self, path, shape):
+        if not self.cache_dir:
+            return None
+        disk_path = self._disk_path(path, shape)
+        if not os.path.exists(disk_path):
+            return None
+        return np.load(disk_path, mmap_mode='r')
+
+    def _store(self, path, mask):
+        packed = np.packbits(mask.reshape(-1))
+        if self.cache_dir:
+            disk_path = self._disk_path(path, mask.shape)
+            tmp = f'{disk_path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, packed)
+            os.replace(tmp, disk_path)
+        return packed
@@ -0,0 +1,178 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import json
+import struct
+import numpy as np
+
+#----------------------------------------------------------------------------#
+# SegFlora mask file (.sfm): lossless binary species mask
+#
+#   8 bytes   magic b'SFMASK01'
+#   4 bytes   header length, little-endian uint32
+#   n bytes   JSON header: shape, encoding, species, plot, height, conf,
+#             source_shape (of the tile the letterboxed mask was predicted on)
+#   padding   to a multiple of 64 bytes
+#   payload   'packbits': np.packbits of the row-major flattened mask
+#             'rle': uint32 run lengths of the flattened mask, alternating
+#             background and foreground, starting with background
+#
+# write_mask (and write_packed, for masks packed on the device) picks
+# whichever encoding is smaller unless one is given; sparse
+# species masks are usually far smaller run-length encoded, packbits can be
+# memory-mapped as is
+#----------------------------------------------------------------------------#
+
+MAGIC = b'SFMASK01'
+ALIGN = 64
+
+#----------------------------------------------------------------------------#
+# letterbox geometry: maps the mask/box grid of the letterboxed tile back
+# to pixels of the original image (same arithmetic as ultralytics LetterBox)
+#----------------------------------------------------------------------------#
+
+def letterbox_geometry(shape, imgsz=864, stride=32):
+    ratio = min(imgsz / shape[0], imgsz / shape[1])
+    width, height = round(shape[1] * ratio), round(shape[0] * ratio)
+    dw, dh = (imgsz - width) % stride / 2, (imgsz - height) % stride / 2
+    return {'ratio': ratio, 'left': round(dw - 0.1), 'top': round(dh - 0.1), 'width': width, 'height': height}
+
+# part of a mask covering the source image, as (row, col, height, width):
+# masks at the image's own pixels are taken whole, letterboxed ones without
+# their padding (the long side of the letterboxed grid is the inference size)
+def mask_window(source_shape, mask_shape):
+    if tuple(mask_shape) == tuple(source_shape):
+        return 0, 0, source_shape[0], source_shape[1]
+    geometry = letterbox_geometry(source_shape, max(mask_shape))
+    return geometry['top'], geometry['left'], geometry['height'], geometry['width']
+
+# window of a mask file covering its source image: masks written with the
+# source_shape of their tile are read without the letterbox padding
+def header_window(header):
+    height, width = header['shape']
+    if 'source_shape' not in header:
+        return 0, 0, height, width
+    return mask_window(header['source_shape'], (height, width))
+
+#----------------------------------------------------------------------------#
+# reading and writing
+#----------------------------------------------------------------------------#
+
+def run_lengths(flat):
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype('<u4')
+
+def write_mask(path, mask, encoding=None, **metadata):
+    mask = np.asarray(mask)
+    flat = mask.reshape(-1) > 0
+    if encoding is None:
+        runs = run_lengths(flat)
+        encoding = 'rle' if runs.nbytes < (flat.size + 7) // 8 else 'packbits'
+    elif encoding == 'rle':
+        runs = run_lengths(flat)
+    if encoding == 'rle':
+        return write_payload(path, runs, mask.shape, 'rle', **metadata)
+    return write_payload(path, np.packbits(flat), mask.shape, 'packbits', **metadata)
+
+# run lengths of a packed mask, as run_lengths of the unpacked one; only the
+# non-zero bytes are unpacked, so sparse masks are never expanded
+def packed_run_lengths(packed, size):
+    nonzero = np.flatnonzero(packed)
+    rows, bits = np.nonzero(np.unpackbits(packed[nonzero]).reshape(-1, 8))
+    ones = nonzero[rows] * 8 + bits
+    ones = ones[ones < size]
+    starts = ones[np.diff(ones, prepend=-2) != 1]
+    ends = ones[np.diff(ones, append=size + 1) != 1] + 1
+    edges = np.stack([starts, ends], 1).reshape(-1)
+    if not edges.size or edges[-1] != size:
+        edges = np.concatenate((edges, [size]))
+    return np.diff(np.concatenate(([0], edges))).astype('<u4')
+
+# for masks already packed (e.g. on the GPU), shape is the unpacked shape;
+# the encoding is picked as in write_mask
+def write_packed(path, packed, shape, encoding=None, **metadata):
+    packed = np.asarray(packed, dtype=np.uint8)
+    if encoding != 'packbits':
+        runs = packed_run_lengths(packed, shape[0] * shape[1])
+        if encoding == 'rle' or runs.nbytes < packed.nbytes:
+            return write_payload(path, runs, shape, 'rle', **metadata)
+    return write_payload(path, packed, shape, 'packbits', **metadata)
+
+def write_payload(path, payload, shape, encoding, **metadata):
+    header = json.dumps(dict(metadata, shape=list(shape), encoding=encoding)).encode()
+    offset = len(MAGIC) + 4 + len(header)
+    padding = -offset % ALIGN
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header + b' ' * padding)
+        f.write(np.ascontiguousarray(payload).tobytes())
+    os.replace(tmp, path)
+    return path
+
+# header dict and byte offset of the payload
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a SegFlora mask file')
+        length = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(length))
+    offset = len(MAGIC) + 4 + length
+    return header, offset + (-offset % ALIGN)
+
+# memory-mapped payload, without decoding
+def read_payload(path):
+    header, offset = read_header(path)
+    dtype = np.dtype('<u4' if header['encoding'] == 'rle' else np.uint8)
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if not count:
+        return np.zeros(0, dtype=dtype), header
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)), header
+
+# the mask over its source image (see header_window), the whole letterboxed
+# grid with padding=True
+def read_mask(path, padding=False):
+    payload, header = read_payload(path)
+    height, width = header['shape']
+    if header['encoding'] == 'rle':
+        values = np.arange(len(payload)) % 2 == 1
+        mask = np.repeat(values, payload).reshape(height, width)
+    else:
+        mask = unpack_mask(payload, (height, width))
+    if padding:
+        return mask
+    top, left, rows, cols = header_window(header)
+    return mask[top:top + rows, left:left + cols]
+
+def unpack_mask(packed, shape):
+    return np.unpackbits(packed, count=shape[0] * shape[1]).view(bool).reshape(shape)
+
+# rows start:stop of a packed mask, touching only the bytes that hold them
+def unpack_rows(packed, shape, start, stop):
+    first, last = start * shape[1], stop * shape[1]
+    bits = np.unpackbits(packed[first // 8:(last + 7) // 8])
+    return bits[first % 8:first % 8 + last - first].view(bool).reshape(stop - start, shape[1])
+
+# (first row, bool rows) chunks of a mask file over its source image (see
+# header_window), decoded from the memory-mapped payload one chunk at a time
+def iter_mask_rows(path, rows=256):
+    payload, header = read_payload(path)
+    height, width = header['shape']
+    top, left, window_rows, window_cols = header_window(header)
+    if header['encoding'] == 'rle':
+        ends = np.cumsum(payload, dtype=np.int64)
+    for start in range(top, top + window_rows, rows):
+        stop = min(start + rows, top + window_rows)
+        if header['encoding'] != 'rle':
+            chunk = unpack_rows(payload, (height, width), start, stop)
+        else:
+            first, last = start * width, stop * width
+            i = np.searchsorted(ends, first, side='right')
+            j = min(np.searchsorted(ends, last, side='left') + 1, len(ends))
+            lengths = np.minimum(ends[i:j], last) - np.maximum(ends[i:j] - payload[i:j], first)
+            chunk = np.repeat(np.arange(i, j) % 2 == 1, lengths).reshape(stop - start, width)
+        yield start - top, chunk[:, left:left + window_cols]
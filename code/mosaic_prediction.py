@@ -0,0 +1,78 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import numpy as np
+import torch
+import rasterio
+from rasterio.windows import Window
+from species import load_species_table
+from prediction_engine import load_models, species_mask, tile_windows
+from geotiff_output import MosaicGeoTIFF
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+path_to_mosaic = "/zenodo/CBarrasso/UAV_SegetalFlora/data/orthomosaics/field_X10.tif"
+path_to_predictions = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/"
+tile = 864     # window size in pixels, also the inference size (multiple of 32)
+overlap = 128  # overlap between neighbouring windows in pixels
+
+#----------------------------------------------------------------------------#
+# windows: the overlapping tiles of tile_windows (prediction_engine.py) as
+# rasterio windows
+#----------------------------------------------------------------------------#
+
+def mosaic_windows(width, height, tile, overlap):
+    for read, core in tile_windows(width, height, tile, overlap):
+        yield Window(*read), Window(*core)
+
+#----------------------------------------------------------------------------#
+# prediction
+#----------------------------------------------------------------------------#
+
+# RGB window, zero padded to tile x tile, as a normalised 1x3xHxW tensor
+def read_window(src, window, tile):
+    img = src.read([1, 2, 3], window=window)
+    if img.dtype != np.uint8:
+        raise ValueError('expected an 8-bit RGB mosaic, got ' + str(img.dtype))
+    padded = np.zeros((3, tile, tile), dtype=np.uint8)
+    padded[:, :img.shape[1], :img.shape[2]] = img
+    return torch.from_numpy(padded).unsqueeze(0).float().div_(255)
+
+# peak memory is one window plus one mask per species, independent of the
+# mosaic size; the full-field masks are streamed to one Cloud-Optimized
+# GeoTIFF per species, overviews accumulated window by window
+def predict_mosaic(path_to_mosaic, species_table, path_to_predictions, tile=864, overlap=128):
+    if tile % 32 or not 0 <= overlap < tile:
+        raise ValueError('tile must be a multiple of 32 and larger than overlap')
+    models = load_models(species_table)
+    name = os.path.splitext(os.path.basename(path_to_mosaic))[0]
+    with rasterio.open(path_to_mosaic) as src:
+        outputs = []
+        for row in species_table:
+            os.makedirs(os.path.join(path_to_predictions, row['prefix']), exist_ok=True)
+            path = os.path.join(path_to_predictions, row['prefix'], row['prefix'] + '_' + name + '.tif')
+            outputs.append(MosaicGeoTIFF(path, src.width, src.height, src.transform, src.crs,
+                                         species=row['species'], conf=row['conf']))
+        try:
+            for read, core in mosaic_windows(src.width, src.height, tile, overlap):
+                x = read_window(src, read, tile)
+                top = core.row_off - read.row_off
+                left = core.col_off - read.col_off
+                for (row, model), dst in zip(models, outputs):
+                    result = model.predict(source=x, imgsz=tile, conf=row['conf'], verbose=False)[0]
+                    mask = species_mask(result)[top:top + core.height, left:left + core.width]
+                    dst.write(mask, core)
+        finally:
+            for dst in outputs:
+                dst.close()
+
+#----------------------------------------------------------------------------#
+# model predict
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    predict_mosaic(path_to_mosaic, load_species_table(), path_to_predictions, tile, overlap)
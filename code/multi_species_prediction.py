@@ -0,0 +1,51 @@
+#----------------------------------------------------------------------------#
+# load required modules 
+#----------------------------------------------------------------------------#
+
+from species import load_species_table
+from prediction_engine import predict_tiles
+from adaptive_prediction import predict_tiles_adaptive
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+path_to_tiles = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/"
+path_to_predictions = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/"
+species_table = load_species_table()
+batch_size = 8       # tiles per forward pass
+decode_workers = 4   # threads decoding and letterboxing tiles ahead of inference
+prefetch = 32        # bound on tiles decoded ahead of inference
+path_to_report = path_to_predictions + "prediction_timing.json"
+mask_format = 'sfm'  # lossless bit-packed masks, 'tif' for georeferenced COGs, 'jpg' for the former images
+path_to_instances = path_to_predictions + "instances.parquet"  # plus instances_plots.parquet, later runs add parts
+path_to_manifest = path_to_predictions + "manifest.jsonl"      # skips tiles already predicted
+write_workers = 4    # background threads writing masks and annotated images, 0 writes inline
+write_queue = 64     # writes pending before inference waits for storage
+backend = 'torch'    # 'onnx' or 'onnx-int8' for ONNX Runtime on CPU, see backend_parity.py
+screen_imgsz = None  # e.g. 320: presence screen at low resolution before full segmentation
+screen_conf = 0.5    # screen threshold as a fraction of each species' conf
+path_to_policy = None  # e.g. adaptive_prediction.RESOLUTION_POLICY: imgsz and tiling per species and height
+
+#----------------------------------------------------------------------------#
+# model predict: all species in one pass over the tiles
+#----------------------------------------------------------------------------#
+
+if path_to_policy:
+    # policy plans have no manifest, instance records, presence screen or
+    # annotated images: refuse to silently run without the ones set above
+    unsupported = [name for name, value in [('path_to_instances', path_to_instances),
+                                            ('path_to_manifest', path_to_manifest),
+                                            ('screen_imgsz', screen_imgsz)] if value]
+    if unsupported:
+        raise ValueError(f"path_to_policy does not support {', '.join(unsupported)}: set them to None")
+    predict_tiles_adaptive(path_to_tiles, species_table, path_to_predictions, path_to_policy, imgsz=864,
+                           batch_size=batch_size, workers=decode_workers, mask_format=mask_format,
+                           path_to_report=path_to_report, backend=backend, write_workers=write_workers,
+                           write_queue=write_queue)
+else:
+    predict_tiles(path_to_tiles, species_table, path_to_predictions, imgsz=864, batch_size=batch_size,
+                  workers=decode_workers, prefetch=prefetch, path_to_report=path_to_report,
+                  mask_format=mask_format, path_to_instances=path_to_instances,
+                  path_to_manifest=path_to_manifest, backend=backend, screen_imgsz=screen_imgsz,
+                  screen_conf=screen_conf, write_workers=write_workers, write_queue=write_queue)
@@ -0,0 +1,80 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import re
+import onnx
+from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                      quantize_static)
+from ultralytics import YOLO
+from prediction_engine import list_tiles, read_tile, preprocess_tile
+
+#----------------------------------------------------------------------------#
+# ONNX Runtime backend for CPU inference: each species model is exported
+# once next to its weights (best.pt -> best.onnx) with dynamic batch and
+# image size, so the letterboxed tensors of the engine go through
+# unchanged; 'onnx-int8' adds a statically quantised copy (best.int8.onnx)
+# calibrated on a few tiles. Exports are redone when the weights are newer.
+# The exported files are loaded with ultralytics.YOLO as before, so NMS,
+# mask decoding and everything after it stay the same.
+#----------------------------------------------------------------------------#
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+def stale(path, source):
+    return not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source)
+
+def export_onnx(weights, imgsz=864):
+    path = os.path.splitext(weights)[0] + '.onnx'
+    if stale(path, weights):
+        YOLO(weights).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+    return path
+
+# letterboxed tiles fed one at a time, as in prediction
+class TileCalibration(CalibrationDataReader):
+
+    def __init__(self, paths, imgsz=864, input_name='images'):
+        self.paths = iter(paths)
+        self.imgsz = imgsz
+        self.input_name = input_name
+
+    def get_next(self):
+        path = next(self.paths, None)
+        if path is None:
+            return None
+        return {self.input_name: preprocess_tile(read_tile(path), self.imgsz).numpy()}
+
+# box and score decoding of the segmentation head stays in float: only its
+# convolutions are quantised, the rest would shift boxes and confidences
+def head_decoding_nodes(model):
+    modules = [int(m.group(1)) for node in model.graph.node
+               for m in [re.match(r'/model\.(\d+)/', node.name)] if m]
+    head = '/model.%d/' % max(modules)
+    return [node.name for node in model.graph.node
+            if node.name.startswith(head) and node.op_type != 'Conv']
+
+def quantize_int8(path_to_onnx, path_to_calibration, imgsz=864, calibration_tiles=16):
+    path = os.path.splitext(path_to_onnx)[0] + '.int8.onnx'
+    if stale(path, path_to_onnx):
+        if path_to_calibration is None:
+            raise ValueError('onnx-int8 needs calibration tiles')
+        tiles = list_tiles(path_to_calibration)
+        tiles = tiles[::max(1, len(tiles) // calibration_tiles)][:calibration_tiles]
+        model = onnx.load(path_to_onnx)
+        quantize_static(path_to_onnx, path, TileCalibration(tiles, imgsz, model.graph.input[0].name),
+                        quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        nodes_to_exclude=head_decoding_nodes(model))
+    return path
+
+# file the backend runs: the weights themselves for 'torch'
+def model_file(weights, backend='torch', imgsz=864, path_to_calibration=None):
+    if backend not in BACKENDS:
+        raise ValueError('unknown backend ' + backend + ', expected one of ' + ', '.join(BACKENDS))
+    if backend == 'torch':
+        return weights
+    path = export_onnx(weights, imgsz)
+    if backend == 'onnx-int8':
+        path = quantize_int8(path, path_to_calibration, imgsz)
+    return path
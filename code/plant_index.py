@@ -0,0 +1,194 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import csv
+import glob
+import math
+import collections
+import numpy as np
+from geotiff_output import source_georeference
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+path_to_instances = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/instances*.parquet"  # also shards
+path_to_plants = "/zenodo/CBarrasso/UAV_SegetalFlora/data/plants.csv"
+group_by = ['species', 'height']  # detections are merged within a species and flight height
+cell_m = 0.5          # grid cell size in field units, about the size of a plant
+min_overlap = 0.5     # box intersection over the smaller box above which two detections are one plant
+crs = None            # CRS of world files without a .prj, e.g. 'EPSG:25833'
+
+#----------------------------------------------------------------------------#
+# field coordinates: instance boxes and centroids (pixels of the original
+# image, see instance_records.py) through the georeference of their tile
+# (geotiff_output.py: the image's own, or a world file next to it)
+#----------------------------------------------------------------------------#
+
+COLUMNS = ['tile', 'plot', 'height', 'species', 'conf', 'x1', 'y1', 'x2', 'y2', 'area_px',
+           'centroid_x', 'centroid_y']
+
+# a tile and species predicted again (a later run's part file, see
+# instance_records.part_path) keeps only the records of the newest file
+def read_instances(paths):
+    import pyarrow.parquet as pq  # optional dependency, only needed for instance records
+    tables, predicted = [], set()
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        table = pq.read_table(path, columns=COLUMNS)
+        keys = list(zip(table.column('tile').to_pylist(), table.column('species').to_pylist()))
+        tables.append(table.filter(np.array([key not in predicted for key in keys], dtype=bool)))
+        plots = path.rsplit('.', 1)[0] + '_plots.parquet'
+        if os.path.exists(plots):
+            plots = pq.read_table(plots, columns=['tile', 'species'])
+            keys = zip(plots.column('tile').to_pylist(), plots.column('species').to_pylist())
+        predicted.update(keys)
+    return {name: np.concatenate([table.column(name).to_numpy(zero_copy_only=False) for table in tables])
+            if tables else np.zeros(0) for name in COLUMNS}
+
+# adds x, y (centroid) and the bounds xmin, ymin, xmax, ymax of the box and
+# area_m2 in field units; instances of tiles without a georeference are
+# dropped and their tiles returned
+def project_instances(instances, crs=None):
+    tiles, index = np.unique(instances['tile'], return_inverse=True)
+    affine = np.full((len(tiles), 6), np.nan)
+    missing = []
+    for i, tile in enumerate(tiles):
+        _, transform, _ = source_georeference(tile, crs) if os.path.exists(tile) else (None, None, None)
+        if transform is None:
+            missing.append(tile)
+        else:
+            affine[i] = transform[:6]
+    a, b, c, d, e, f = affine[index].T
+    keep = ~np.isnan(a)
+    projected = {name: values[keep] for name, values in instances.items()}
+    a, b, c, d, e, f = a[keep], b[keep], c[keep], d[keep], e[keep], f[keep]
+    corners_x, corners_y = [], []
+    for col, row in [('x1', 'y1'), ('x2', 'y1'), ('x1', 'y2'), ('x2', 'y2')]:
+        corners_x.append(a * projected[col] + b * projected[row] + c)
+        corners_y.append(d * projected[col] + e * projected[row] + f)
+    projected.update(
+        x=a * projected['centroid_x'] + b * projected['centroid_y'] + c,
+        y=d * projected['centroid_x'] + e * projected['centroid_y'] + f,
+        xmin=np.min(corners_x, 0), ymin=np.min(corners_y, 0), xmax=np.max(corners_x, 0), ymax=np.max(corners_y, 0),
+        area_m2=projected['area_px'] * np.abs(a * e - b * d))
+    return projected, missing
+
+#----------------------------------------------------------------------------#
+# deduplication: detections are taken by descending confidence (as NMS) and
+# looked up in a uniform grid of cell_m cells holding the plants found so
+# far; a detection whose box overlaps a plant's box by min_overlap
+# (intersection over the smaller box, so plants cut at an image border
+# still match) joins the best-overlapping plant, otherwise it starts a new
+# one. A lookup only visits the cells its box covers, so the cost per
+# detection does not grow with the number of plants.
+#----------------------------------------------------------------------------#
+
+class PlantGrid:
+
+    def __init__(self, cell=0.5):
+        self.cell = cell
+        self.cells = collections.defaultdict(list)
+        self.boxes = []
+
+    def _cells(self, box):
+        i0, j0 = math.floor(box[0] / self.cell), math.floor(box[1] / self.cell)
+        i1, j1 = math.floor(box[2] / self.cell), math.floor(box[3] / self.cell)
+        return [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+    # index and overlap of the best-overlapping plant, (None, 0.0) if none
+    def match(self, box):
+        best, best_overlap = None, 0.0
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        seen = set()
+        for cell in self._cells(box):
+            for plant in self.cells.get(cell, ()):
+                if plant in seen:
+                    continue
+                seen.add(plant)
+                other = self.boxes[plant]
+                width = min(box[2], other[2]) - max(box[0], other[0])
+                height = min(box[3], other[3]) - max(box[1], other[1])
+                if width <= 0 or height <= 0:
+                    continue
+                smaller = min(area, (other[2] - other[0]) * (other[3] - other[1]))
+                overlap = width * height / smaller if smaller > 0 else 1.0
+                if overlap > best_overlap:
+                    best, best_overlap = plant, overlap
+        return best, best_overlap
+
+    def insert(self, box):
+        plant = len(self.boxes)
+        self.boxes.append(box)
+        for cell in self._cells(box):
+            self.cells[cell].append(plant)
+        return plant
+
+PLANT_COLUMNS = ['species', 'height', 'plot', 'x', 'y', 'xmin', 'ymin', 'xmax', 'ymax', 'area_m2', 'conf',
+                 'detections', 'images']
+
+# one record per plant and group: box, plot and area of its most confident
+# detection, centroid averaged over its detections weighted by confidence
+def merge_detections(projected, group_by=('species', 'height'), cell=0.5, min_overlap=0.5):
+    keys = list(zip(*(projected[name] for name in group_by)))
+    order = np.argsort(-projected['conf'], kind='stable')
+    grids = {}
+    plants = []
+    for i in order:
+        key = keys[i]
+        grid = grids.get(key)
+        if grid is None:
+            grid = grids[key] = (PlantGrid(cell), [])
+        box = (projected['xmin'][i], projected['ymin'][i], projected['xmax'][i], projected['ymax'][i])
+        plant, overlap = grid[0].match(box)
+        conf = float(projected['conf'][i])
+        if plant is not None and overlap >= min_overlap:
+            record = grid[1][plant]
+            record['weight'] += conf
+            record['x'] += conf * projected['x'][i]
+            record['y'] += conf * projected['y'][i]
+            record['detections'] += 1
+            record['tiles'].add(projected['tile'][i])
+            continue
+        grid[0].insert(box)
+        record = {'species': projected['species'][i], 'height': projected['height'][i], 'plot': projected['plot'][i],
+                  'xmin': box[0], 'ymin': box[1], 'xmax': box[2], 'ymax': box[3],
+                  'area_m2': float(projected['area_m2'][i]), 'conf': conf, 'weight': conf,
+                  'x': conf * projected['x'][i], 'y': conf * projected['y'][i], 'detections': 1,
+                  'tiles': {projected['tile'][i]}}
+        grid[1].append(record)
+        plants.append(record)
+    for record in plants:
+        weight = record.pop('weight')
+        record['x'] /= weight
+        record['y'] /= weight
+        record['images'] = len(record.pop('tiles'))
+    return plants
+
+def write_plants(plants, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, PLANT_COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(plants)
+
+def print_plant_counts(projected, plants, group_by=('species', 'height')):
+    detections = collections.Counter(zip(*(projected[name] for name in group_by)))
+    counts = collections.Counter(tuple(plant[name] for name in group_by) for plant in plants)
+    print(''.join(f'{name:<20}' for name in group_by) + f"{'detections':>12}{'plants':>10}{'per plant':>11}")
+    for key in sorted(counts, key=lambda key: [str(value) for value in key]):
+        print(''.join(f'{str(value):<20}' for value in key)
+              + f'{detections[key]:>12}{counts[key]:>10}{detections[key] / counts[key]:>11.2f}')
+
+#----------------------------------------------------------------------------#
+# run
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    paths = sorted(path for path in glob.glob(path_to_instances) if not path.endswith('_plots.parquet'))
+    projected, missing = project_instances(read_instances(paths), crs)
+    if missing:
+        print(f'{len(missing)} tiles without georeference skipped, e.g. {missing[0]}')
+    plants = merge_detections(projected, group_by, cell_m, min_overlap)
+    write_plants(plants, path_to_plants)
+    print_plant_counts(projected, plants, group_by)
@@ -0,0 +1,370 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import torch
+from ultralytics import YOLO
+from ultralytics.data.augment import LetterBox
+from profiling import StageTimer
+from species import flight_of
+from mask_format import write_mask, write_packed, unpack_mask
+from instance_records import InstanceWriter, letterbox_geometry
+from manifest import Manifest
+from async_writer import AsyncWriter
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.webp')
+
+#----------------------------------------------------------------------------#
+# tiles
+#----------------------------------------------------------------------------#
+
+# a folder of tiles, a single tile or a list of tile paths
+def list_tiles(path_to_tiles):
+    if isinstance(path_to_tiles, (list, tuple)):
+        return list(path_to_tiles)
+    if os.path.isfile(path_to_tiles):
+        return [path_to_tiles]
+    return sorted(os.path.join(path_to_tiles, name) for name in os.listdir(path_to_tiles)
+                  if name.lower().endswith(IMAGE_SUFFIXES))
+
+def read_tile(path):
+    img = cv2.imread(path)
+    if img is None:
+        raise IOError('cannot decode ' + path)
+    return img
+
+# same letterbox as ultralytics applies to a single image, so the masks keep
+# the shape the per-species scripts used to produce
+def preprocess_tile(img, imgsz=864, stride=32):
+    img = LetterBox(new_shape=(imgsz, imgsz), auto=True, stride=stride)(image=img)
+    img = img[..., ::-1].transpose(2, 0, 1)  # BGR HWC to RGB CHW
+    return torch.from_numpy(np.ascontiguousarray(img)).unsqueeze(0).float().div_(255)
+
+# (path, letterboxed tensor, original (height, width))
+def load_tile(path, imgsz=864, timer=None):
+    timer = timer or StageTimer()
+    with timer.stage('decode', [path]):
+        img = read_tile(path)
+    with timer.stage('preprocess', [path]):
+        return path, preprocess_tile(img, imgsz), img.shape[:2]
+
+# function(item, *args) in input order; a pool of workers runs at most
+# `prefetch` items ahead of the consumer
+def prefetch_map(function, items, args=(), workers=4, prefetch=32):
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque(pool.submit(function, item, *args)
+                                    for item in itertools.islice(items, prefetch))
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(pool.submit(function, item, *args))
+            yield result
+
+# decoded and letterboxed tiles in input order, decoded ahead of inference
+# so decoding overlaps with the models instead of alternating with them
+def prefetch_tiles(paths, imgsz=864, workers=4, prefetch=32, timer=None):
+    return prefetch_map(load_tile, paths, (imgsz, timer), workers, prefetch)
+
+# consecutive tiles of the same letterboxed shape, at most batch_size each
+def batch_tiles(tiles, batch_size=8):
+    batch = []
+    for tile in tiles:
+        if batch and (len(batch) == batch_size or batch[0][1].shape != tile[1].shape):
+            yield batch
+            batch = []
+        batch.append(tile)
+    if batch:
+        yield batch
+
+#----------------------------------------------------------------------------#
+# windows: overlapping tiles covering an image or mosaic, the last one flush
+# with the border; every output pixel is owned by exactly one tile (the
+# overlap is split half-way), so each mask pixel is written once
+#----------------------------------------------------------------------------#
+
+def tile_origins(size, tile, overlap):
+    if size <= tile:
+        return [0]
+    origins = list(range(0, size - tile + 1, tile - overlap))
+    if origins[-1] + tile < size:
+        origins.append(size - tile)
+    return origins
+
+def core_cuts(origins, size, tile):
+    return [0] + [(origins[i - 1] + tile + origins[i]) // 2 for i in range(1, len(origins))] + [size]
+
+# (read, core) windows as (col_off, row_off, width, height)
+def tile_windows(width, height, tile, overlap):
+    xs = tile_origins(width, tile, overlap)
+    ys = tile_origins(height, tile, overlap)
+    x_cuts = core_cuts(xs, width, tile)
+    y_cuts = core_cuts(ys, height, tile)
+    for j, y0 in enumerate(ys):
+        for i, x0 in enumerate(xs):
+            yield ((x0, y0, min(tile, width - x0), min(tile, height - y0)),
+                   (x_cuts[i], y_cuts[j], x_cuts[i + 1] - x_cuts[i], y_cuts[j + 1] - y_cuts[j]))
+
+#----------------------------------------------------------------------------#
+# models and masks
+#----------------------------------------------------------------------------#
+
+# backend 'torch' runs the weights as they are, 'onnx' and 'onnx-int8' an
+# ONNX Runtime export of them (see onnx_backend.py); row['model'] is the
+# file actually run, so manifest keys differ between backends
+def load_models(species_table, backend='torch', imgsz=864, path_to_calibration=None):
+    if backend == 'torch':
+        return [(row, YOLO(row['model'])) for row in species_table]
+    from onnx_backend import model_file  # optional dependency, only needed for the onnx backends
+    models = []
+    for row in species_table:
+        path = model_file(row['model'], backend, imgsz, path_to_calibration)
+        models.append((dict(row, model=path), YOLO(path, task='segment')))
+    return models
+
+# union of the species instances (class 0) of a result, taken in place in a
+# preallocated buffer per mask shape and device and bit-packed there, so
+# only ceil(h*w/8) bytes leave the device; packed is None for tiles without
+# any instance of the species, which skip the union altogether
+BIT_WEIGHTS = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+
+class MaskUnion:
+
+    def __init__(self):
+        self.buffers = {}
+
+    def _buffers(self, masks):
+        shape = tuple(masks.shape[1:])
+        key = (shape, str(masks.device), masks.dtype)
+        if key not in self.buffers:
+            size = shape[0] * shape[1]
+            padded = torch.zeros((size + 7) // 8 * 8, dtype=torch.bool, device=masks.device)
+            self.buffers[key] = (torch.empty(shape, dtype=masks.dtype, device=masks.device),
+                                 padded, padded[:size].view(shape),
+                                 torch.empty((len(padded) // 8, 8), dtype=torch.uint8, device=masks.device),
+                                 torch.empty(len(padded) // 8, dtype=torch.uint8, device=masks.device),
+                                 BIT_WEIGHTS.to(masks.device))
+        return self.buffers[key]
+
+    def __call__(self, result):
+        if result.masks is None:
+            return None, tuple(result.orig_shape)
+        masks = result.masks.data
+        shape = tuple(masks.shape[1:])
+        species = result.boxes.cls == 0
+        if not species.any():
+            return None, shape
+        highest, padded, union, bits, packed, weights = self._buffers(masks)
+        if species.all():
+            torch.amax(masks, 0, out=highest)
+            torch.gt(highest, 0, out=union)
+        else:
+            union.zero_()
+            for i in torch.nonzero(species).flatten().tolist():
+                torch.logical_or(union, masks[i], out=union)
+        torch.mul(padded.view(-1, 8), weights, out=bits)
+        torch.sum(bits, 1, dtype=torch.uint8, out=packed)
+        return packed.to('cpu', copy=True).numpy(), shape
+
+def unpack_or_empty(packed, shape):
+    return np.zeros(shape, dtype=bool) if packed is None else unpack_mask(packed, shape)
+
+# 0/255 uint8 image of the union, as the per-species scripts used to write
+default_union = MaskUnion()
+
+def species_mask(result):
+    return unpack_or_empty(*default_union(result)).view(np.uint8) * np.uint8(255)
+
+def prediction_path(path_to_predictions, row, tile_path, suffix='.jpg'):
+    name = os.path.basename(tile_path)
+    return os.path.join(path_to_predictions, row['prefix'], row['prefix'] + '_' + name + suffix)
+
+# 'jpg' keeps the former 0/255 images, 'sfm' writes lossless bit-packed
+# masks with their species, plot, height and threshold (see mask_format.py),
+# 'tif' Cloud-Optimized GeoTIFFs georeferenced like the tile, with the same
+# metadata as tags (see geotiff_output.py)
+def write_prediction(path_to_predictions, row, tile_path, packed, shape, mask_format='jpg', source_shape=None):
+    path = prediction_path(path_to_predictions, row, tile_path, '.' + mask_format)
+    if mask_format in ('sfm', 'tif'):
+        plot, height = flight_of(tile_path)
+        metadata = {'species': row['species'], 'plot': plot, 'height': height, 'conf': row['conf']}
+        if mask_format == 'sfm':
+            # readers crop the letterbox padding with it (mask_format.header_window)
+            if source_shape is not None:
+                metadata['source_shape'] = [int(size) for size in source_shape]
+            if packed is not None:
+                return write_packed(path, packed, shape, **metadata)
+        mask = unpack_or_empty(packed, shape)
+        if mask_format == 'tif':
+            from geotiff_output import write_geotiff  # optional dependency, only needed for GeoTIFF masks
+            return write_geotiff(path, mask, tile_path, **metadata)
+        return write_mask(path, mask, **metadata)
+    mask = unpack_or_empty(packed, shape)
+    if not cv2.imwrite(path, mask.view(np.uint8) * np.uint8(255)):
+        raise IOError('cannot write ' + path)
+    return path
+
+# mask, annotated image (if result is given) and manifest entry of one tile
+# and species, run by the output stage once inference has moved on;
+# source_shape is the (height, width) of the tile before letterboxing
+def write_outputs(timer, path_to_predictions, row, path, packed, mask_shape, mask_format, result=None,
+                  manifest=None, key=None, source_shape=None):
+    with timer.stage('write', [path]):
+        outputs = [write_prediction(path_to_predictions, row, path, packed, mask_shape, mask_format, source_shape)]
+        if result is not None:
+            outputs.append(os.path.join(path_to_predictions, row['prefix'], 'annotated', os.path.basename(path)))
+            if not cv2.imwrite(outputs[-1], result.plot(line_width=1)):
+                raise IOError('cannot write ' + outputs[-1])
+        if manifest:
+            manifest.record(key, path, row['prefix'], outputs)
+
+# closes the output stage: the other output files (instance records,
+# manifest) are closed even when writes failed, and write errors are only
+# raised when no other exception is on its way out
+def close_outputs(writer, *files, failing=False):
+    try:
+        writer.close()
+    except IOError as error:
+        if not failing:
+            raise
+        print(f'while handling another error: {error}')
+    finally:
+        for f in files:
+            if f:
+                f.close()
+
+#----------------------------------------------------------------------------#
+# single-pass prediction: every tile is decoded and letterboxed once and the
+# same batch tensor is fed to all species models
+#----------------------------------------------------------------------------#
+
+# (tile, species) predictions still to run: all of them, or with a manifest
+# those without a finished entry for the current tile, weights and settings
+def pending_predictions(tiles, models, imgsz, mask_format, manifest=None):
+    if manifest is None:
+        return {path: [None] * len(models) for path in tiles}
+    weights = [manifest.digest(row['model']) for row, _ in models]
+    pending = {}
+    for path in tiles:
+        tile_digest = manifest.digest(path)
+        keys = [Manifest.key(path, tile_digest, row['prefix'], digest, imgsz, row['conf'], mask_format)
+                for digest, (row, _) in zip(weights, models)]
+        keys = [None if manifest.done(key) else key for key in keys]
+        if any(keys):
+            pending[path] = keys
+    return pending
+
+# presence screen: each species model runs on the batch shrunk to
+# screen_imgsz (sides kept multiples of the stride) with its threshold
+# scaled by screen_conf; tiles without any instance of the species there
+# are skipped at full resolution and get an empty mask
+def shrink_batch(x, imgsz, screen_imgsz, stride=32):
+    size = [max(stride, round(side * screen_imgsz / imgsz / stride) * stride) for side in x.shape[2:]]
+    return torch.nn.functional.interpolate(x, size=size, mode='area')
+
+def screen_batch(model, row, x, imgsz, screen_imgsz, screen_conf=0.5):
+    results = model.predict(source=shrink_batch(x, imgsz, screen_imgsz), imgsz=screen_imgsz,
+                            conf=row['conf'] * screen_conf, verbose=False)
+    return [bool((result.boxes.cls == 0).any()) for result in results]
+
+def skip_rates(timer, models):
+    rates = {}
+    for row, _ in models:
+        screened = timer.counters.get('screened ' + row['prefix'], 0)
+        if screened:
+            rates[row['prefix']] = timer.counters.get('skipped ' + row['prefix'], 0) / screened
+    return rates
+
+# stages timed: model load, decode, preprocess, inference (the ultralytics
+# call, including NMS and mask decoding), mask union and writing; the
+# report is written to path_to_report (.json or .csv) if given; with
+# path_to_instances, per-instance records and per-plot instance counts and
+# cover are streamed to Parquet while predicting; with path_to_manifest,
+# tiles and species already predicted with the same weights and settings
+# are skipped, so an interrupted or incremental run only does what is left;
+# backend picks the inference runtime, onnx-int8 is calibrated on the tiles
+# in path_to_calibration (path_to_tiles if None); with screen_imgsz, only
+# tiles passing the presence screen of a species are segmented for it;
+# outputs are written by write_workers background threads, inference
+# waiting ('write wait') only when write_queue writes are pending; shard
+# names the manifest shard of one of several processes sharing it
+def predict_tiles(path_to_tiles, species_table, path_to_predictions, imgsz=864, batch_size=8,
+                  workers=4, prefetch=32, save_annotated=True, path_to_report=None, mask_format='jpg',
+                  path_to_instances=None, path_to_manifest=None, backend='torch', path_to_calibration=None,
+                  screen_imgsz=None, screen_conf=0.5, write_workers=4, write_queue=64, shard=None):
+    timer = StageTimer()
+    with timer.stage('model load'):
+        models = load_models(species_table, backend, imgsz, path_to_calibration or path_to_tiles)
+    for row in species_table:
+        os.makedirs(os.path.join(path_to_predictions, row['prefix'], 'annotated' if save_annotated else ''),
+                    exist_ok=True)
+    writer = AsyncWriter(write_workers, write_queue)
+    instances = InstanceWriter(path_to_instances) if path_to_instances else None
+    if instances and instances.path != path_to_instances:
+        print(f'{path_to_instances} exists, instance records of this run go to {instances.path}')
+    manifest = Manifest(path_to_manifest, shard) if path_to_manifest else None
+
+    tiles = list_tiles(path_to_tiles)
+    # screened runs get their own manifest keys, their empty masks are not
+    # interchangeable with full-resolution ones
+    settings = f'{imgsz}:screen{screen_imgsz}@{screen_conf}' if screen_imgsz else imgsz
+    pending = pending_predictions(tiles, models, settings, mask_format, manifest)
+    if manifest:
+        print(f'{len(tiles) - len(pending)} of {len(tiles)} tiles already predicted')
+    union = MaskUnion()
+    try:
+        for batch in batch_tiles(prefetch_tiles(list(pending), imgsz, workers, prefetch, timer), batch_size):
+            x = torch.cat([tensor for _, tensor, _ in batch])
+            for m, (row, model) in enumerate(models):
+                todo = [tile for tile in batch if manifest is None or pending[tile[0]][m]]
+                if not todo:
+                    continue
+                x_todo = x if len(todo) == len(batch) else torch.cat([tensor for _, tensor, _ in todo])
+                if screen_imgsz:
+                    with timer.stage('screen', [path for path, _, _ in todo]):
+                        candidates = screen_batch(model, row, x_todo, imgsz, screen_imgsz, screen_conf)
+                    timer.count('screened ' + row['prefix'], len(todo))
+                    timer.count('skipped ' + row['prefix'], candidates.count(False))
+                    for (path, tensor, shape), candidate in zip(todo, candidates):
+                        if candidate:
+                            continue
+                        if instances:
+                            instances.add_empty(path, row, letterbox_geometry(shape, imgsz))
+                        with timer.stage('write wait', [path]):
+                            writer.submit(write_outputs, timer, path_to_predictions, row, path, None,
+                                          tuple(tensor.shape[2:]), mask_format, None, manifest, pending[path][m],
+                                          shape)
+                    if not all(candidates):
+                        todo = [tile for tile, candidate in zip(todo, candidates) if candidate]
+                        if not todo:
+                            continue
+                        x_todo = torch.cat([tensor for _, tensor, _ in todo])
+                paths = [path for path, _, _ in todo]
+                with timer.stage('inference', paths):
+                    results = model.predict(source=x_todo, imgsz=imgsz, conf=row['conf'], verbose=False)
+                for (path, _, shape), result in zip(todo, results):
+                    with timer.stage('postprocess', [path]):
+                        packed, mask_shape = union(result)
+                        if instances:
+                            instances.add(path, row, result, packed, letterbox_geometry(shape, imgsz))
+                    with timer.stage('write wait', [path]):
+                        writer.submit(write_outputs, timer, path_to_predictions, row, path, packed, mask_shape,
+                                      mask_format, result if save_annotated else None, manifest, pending[path][m],
+                                      shape)
+    except BaseException:
+        close_outputs(writer, instances, manifest, failing=True)
+        raise
+    close_outputs(writer, instances, manifest)
+    print(timer.summary())
+    rates = skip_rates(timer, models)
+    if rates:
+        print('skipped by the presence screen: ' + ', '.join(f'{prefix} {rate:.0%}' for prefix, rate in rates.items()))
+    if path_to_report:
+        timer.write(path_to_report)
+    return timer.report()
@@ -0,0 +1,296 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import json
+import time
+import queue
+import itertools
+import threading
+import socketserver
+import urllib.parse
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import numpy as np
+import torch
+from profiling import StageTimer
+from species import load_species_table
+from prediction_engine import read_tile, preprocess_tile, load_models, MaskUnion
+from instance_records import instance_table, letterbox_geometry, packed_count
+from mask_format import run_lengths, unpack_mask
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+species_table = load_species_table()
+host = '127.0.0.1'
+port = 8765
+path_to_socket = None   # serve on this Unix socket instead of host:port
+imgsz = 864
+batch_size = 8          # tiles per forward pass
+max_wait_ms = 20        # how long a forward pass waits for more tiles to batch
+backend = 'torch'       # 'onnx' or 'onnx-int8' for ONNX Runtime on CPU
+preload = False         # load and warm all species models at start, else on first use
+
+#----------------------------------------------------------------------------#
+# resident prediction server: the species models are loaded once (lazily,
+# on the first request for the species, unless preloaded) and kept warm;
+# requests from any number of connections are queued and batched into
+# forward passes by a single inference thread
+#
+#   POST /predict   body: JSON {"paths": [...], "species": [...], "output": ...}
+#                   with tile paths readable by the server, or the bytes of one
+#                   image (species and output then as query parameters);
+#                   species are prefixes of species.csv (all if omitted),
+#                   output is 'mask', 'instances' or 'both' (default)
+#   GET  /species   species table and which models are loaded
+#   GET  /stats     throughput and latency overall and per species
+#                   (?reset=1 starts new counters)
+#
+# masks come back run-length encoded at the letterboxed grid, as in the
+# .sfm files: alternating background/foreground runs of the row-major mask,
+# starting with background; instances in pixels of the original image
+#----------------------------------------------------------------------------#
+
+# models by prefix, loaded on first use; a dummy forward pass at load time
+# keeps the first request from paying for lazy initialisation
+class ModelPool:
+
+    def __init__(self, species_table, backend='torch', imgsz=864):
+        self.rows = {row['prefix']: row for row in species_table}
+        self.backend = backend
+        self.imgsz = imgsz
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def check(self, prefixes):
+        unknown = set(prefixes) - set(self.rows)
+        if unknown:
+            raise ValueError('unknown species prefix: ' + ', '.join(sorted(unknown)))
+
+    def get(self, prefix):
+        with self.lock:
+            if prefix not in self.models:
+                row, model = load_models([self.rows[prefix]], self.backend, self.imgsz)[0]
+                model.predict(source=torch.zeros(1, 3, self.imgsz, self.imgsz), imgsz=self.imgsz,
+                              conf=row['conf'], verbose=False)
+                self.models[prefix] = (row, model)
+            return self.models[prefix]
+
+# collects queued tiles for up to max_wait seconds or batch_size tiles, then
+# runs every requested species on the tiles of the same letterboxed shape;
+# per-species timers count queueing, inference and post-processing of each
+# tile, so their latencies are what a request for that species waits
+class Batcher:
+
+    def __init__(self, pool, batch_size=8, max_wait=0.02):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.union = MaskUnion()
+        self.ids = itertools.count()
+        self.reset()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def reset(self):
+        self.timers = {prefix: StageTimer() for prefix in self.pool.rows}
+
+    # future resolved to {prefix: (packed mask, mask shape, instances)}
+    def submit(self, tensor, shape, prefixes):
+        future = Future()
+        self.queue.put((next(self.ids), tensor, shape, prefixes, time.perf_counter(), future))
+        return future
+
+    def collect(self):
+        items = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(items) < self.batch_size:
+            try:
+                items.append(self.queue.get(timeout=max(0, deadline - time.perf_counter())))
+            except queue.Empty:
+                break
+        return items
+
+    def run(self):
+        while True:
+            items = self.collect()
+            groups = {}
+            for item in items:
+                groups.setdefault(tuple(item[1].shape), []).append(item)
+            for group in groups.values():
+                outputs = [{} for _ in group]
+                try:
+                    for prefix in dict.fromkeys(p for item in group for p in item[3]):
+                        self.predict(prefix, group, outputs)
+                except Exception as error:
+                    for item in group:
+                        item[5].set_exception(error)
+                    continue
+                for item, output in zip(group, outputs):
+                    item[5].set_result(output)
+
+    def predict(self, prefix, group, outputs):
+        todo = [i for i, item in enumerate(group) if prefix in item[3]]
+        ids = [group[i][0] for i in todo]
+        timer = self.timers[prefix]
+        now = time.perf_counter()
+        for i in todo:
+            timer.add('queue', now - group[i][4], [group[i][0]])
+        row, model = self.pool.get(prefix)
+        x = torch.cat([group[i][1] for i in todo])
+        with timer.stage('inference', ids):
+            results = model.predict(source=x, imgsz=self.pool.imgsz, conf=row['conf'], verbose=False)
+        for i, result in zip(todo, results):
+            with timer.stage('postprocess', [group[i][0]]):
+                packed, mask_shape = self.union(result)
+                table = instance_table(result, letterbox_geometry(group[i][2], self.pool.imgsz))
+                outputs[i][prefix] = (packed, mask_shape, table)
+
+def instance_records(table):
+    species = table['class'] == 0
+    names = [name for name in table if name != 'class']
+    return [dict(zip(names, values)) for values in zip(*[table[name][species].tolist() for name in names])]
+
+def encode_output(tile, shape, output, what):
+    species = {}
+    for prefix, (packed, mask_shape, table) in output.items():
+        entry = {'cover_px': packed_count(packed), 'instances_count': int((table['class'] == 0).sum())}
+        if what in ('mask', 'both'):
+            mask = np.zeros(mask_shape[0] * mask_shape[1], dtype=bool) if packed is None \
+                else unpack_mask(packed, mask_shape).reshape(-1)
+            entry['mask'] = {'shape': list(mask_shape), 'encoding': 'rle', 'runs': run_lengths(mask).tolist()}
+        if what in ('instances', 'both'):
+            entry['instances'] = instance_records(table)
+        species[prefix] = entry
+    return {'tile': tile, 'shape': list(shape), 'species': species}
+
+#----------------------------------------------------------------------------#
+# HTTP interface
+#----------------------------------------------------------------------------#
+
+class PredictionHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # Unix socket peers have no (host, port) address
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix socket'
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        batcher, pool = self.server.batcher, self.server.pool
+        if url.path == '/species':
+            return self.send_json(200, [dict(row, loaded=row['prefix'] in pool.models) for row in pool.rows.values()])
+        if url.path == '/stats':
+            stats = {'server': self.server.timer.report(),
+                     'species': {prefix: timer.report() for prefix, timer in batcher.timers.items()
+                                 if timer.calls}}
+            if query.get('reset', ['0'])[0] == '1':
+                self.server.timer = StageTimer()
+                batcher.reset()
+            return self.send_json(200, stats)
+        self.send_json(404, {'error': 'unknown path ' + url.path})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/predict':
+            return self.send_json(404, {'error': 'unknown path ' + url.path})
+        query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                fields = json.loads(body)
+                if not isinstance(fields, dict):
+                    raise ValueError('the JSON body must be an object')
+                request = dict(query, **fields)
+            else:
+                request = dict(query, image=body)
+            self.send_json(200, self.predict(request))
+        except (ValueError, TypeError, IOError) as error:  # TypeError: fields of the wrong type
+            self.send_json(400, {'error': str(error)})
+        except RuntimeError as error:  # model load or inference
+            self.send_json(500, {'error': str(error)})
+
+    def predict(self, request):
+        pool, batcher, timer = self.server.pool, self.server.batcher, self.server.timer
+        prefixes = request.get('species') or list(pool.rows)
+        if isinstance(prefixes, str):
+            prefixes = prefixes.split(',')
+        if not isinstance(prefixes, list) or not all(isinstance(prefix, str) for prefix in prefixes):
+            raise ValueError('species must be a list of species prefixes or a comma-separated string')
+        pool.check(prefixes)
+        what = request.get('output', 'both')
+        if what not in ('mask', 'instances', 'both'):
+            raise ValueError("output must be 'mask', 'instances' or 'both'")
+        tiles = request.get('paths') or ['upload']
+        if 'image' not in request and (not isinstance(tiles, list)
+                                       or not all(isinstance(tile, str) for tile in tiles)):
+            raise ValueError('paths must be a list of tile paths')
+        pending = []
+        for tile in tiles:
+            with timer.stage('decode', [tile]):
+                if 'image' in request:
+                    img = cv2.imdecode(np.frombuffer(request['image'], np.uint8), cv2.IMREAD_COLOR)
+                    if img is None:
+                        raise IOError('cannot decode the uploaded image')
+                else:
+                    img = read_tile(tile)
+                tensor = preprocess_tile(img, pool.imgsz)
+            pending.append((tile, img.shape[:2], batcher.submit(tensor, img.shape[:2], prefixes)))
+        tiles = []
+        for tile, shape, future in pending:
+            try:
+                output = future.result()
+            except Exception as error:
+                raise RuntimeError(f'inference failed: {error!r}') from error
+            with timer.stage('encode', [tile]):
+                tiles.append(encode_output(tile, shape, output, what))
+        return {'tiles': tiles}
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(species_table, host='127.0.0.1', port=8765, path_to_socket=None, imgsz=864,
+                batch_size=8, max_wait_ms=20, backend='torch', preload=False):
+    pool = ModelPool(species_table, backend, imgsz)
+    if preload:
+        for prefix in pool.rows:
+            pool.get(prefix)
+    if path_to_socket:
+        if os.path.exists(path_to_socket):
+            os.remove(path_to_socket)
+        server = UnixHTTPServer(path_to_socket, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.pool = pool
+    server.batcher = Batcher(pool, batch_size, max_wait_ms / 1e3)
+    server.timer = StageTimer()
+    return server
+
+#----------------------------------------------------------------------------#
+# run
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    server = make_server(species_table, host, port, path_to_socket, imgsz, batch_size, max_wait_ms,
+                         backend, preload)
+    print('serving on ' + (path_to_socket or f'http://{host}:{port}'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
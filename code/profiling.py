@@ -0,0 +1,108 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import csv
+import json
+import time
+import threading
+import contextlib
+import collections
+import numpy as np
+
+#----------------------------------------------------------------------------#
+# per-stage timing: wall-clock seconds per pipeline stage, shared between
+# the decode workers and the inference loop; time spent on a batch is
+# split evenly over its tiles to give per-tile latencies; counters keep
+# plain event counts alongside (e.g. tiles skipped by a stage). Throughput
+# is taken from the start of the first stage that handles tiles, so model
+# loading, export and other setup do not count against it
+#----------------------------------------------------------------------------#
+
+class StageTimer:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.latency = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        self.start = time.perf_counter()
+        self.first_tile = None
+
+    @contextlib.contextmanager
+    def stage(self, name, tiles=()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, tiles)
+
+    def add(self, name, seconds, tiles=()):
+        with self.lock:
+            self.totals[name] += seconds
+            self.calls[name] += 1
+            if tiles:
+                start = time.perf_counter() - seconds
+                self.first_tile = start if self.first_tile is None else min(self.first_tile, start)
+            for tile in tiles:
+                self.latency[tile] += seconds / len(tiles)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    # stage totals are summed over threads, so with several decode workers
+    # they can exceed the elapsed wall-clock time
+    def report(self):
+        now = time.perf_counter()
+        elapsed = now - self.start
+        processing = now - self.first_tile if self.first_tile is not None else 0.0
+        latency = np.array(list(self.latency.values())) * 1e3
+        percentiles = np.percentile(latency, [50, 95, 99]) if len(latency) else [np.nan] * 3
+        return {
+            'tiles': len(latency),
+            'elapsed_s': elapsed,
+            'model_load_s': self.totals.get('model load', 0.0),
+            'processing_s': processing,
+            'throughput_images_s': len(latency) / processing if processing else np.nan,
+            'latency_ms': dict(zip(['p50', 'p95', 'p99'], map(float, percentiles))),
+            'stages': {name: {'total_s': self.totals[name], 'calls': self.calls[name],
+                              'mean_ms': self.totals[name] / self.calls[name] * 1e3}
+                       for name in self.totals},
+            'counters': dict(self.counters),
+            }
+
+    # .json keeps the nested report, anything else is written as a flat csv
+    def write(self, path):
+        report = self.report()
+        if os.path.splitext(path)[1] == '.json':
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            return report
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['metric', 'stage', 'value'])
+            for key in ['tiles', 'elapsed_s', 'model_load_s', 'processing_s', 'throughput_images_s']:
+                writer.writerow([key, '', report[key]])
+            for key, value in report['latency_ms'].items():
+                writer.writerow(['latency_ms_' + key, '', value])
+            for name, stage in report['stages'].items():
+                for key, value in stage.items():
+                    writer.writerow([key, name, value])
+            for name, value in report['counters'].items():
+                writer.writerow(['count', name, value])
+        return report
+
+    def summary(self):
+        report = self.report()
+        lines = [f"{report['tiles']} tiles in {report['processing_s']:.1f} s "
+                 f"({report['elapsed_s']:.1f} s with {report['model_load_s']:.1f} s model load): "
+                 f"{report['throughput_images_s']:.2f} images/s, latency p50/p95/p99 "
+                 + '/'.join(f'{value:.0f}' for value in report['latency_ms'].values()) + ' ms']
+        for name, stage in report['stages'].items():
+            lines.append(f"  {name:<12} {stage['total_s']:8.2f} s {stage['calls']:7d} calls {stage['mean_ms']:9.2f} ms/call")
+        for name, value in report['counters'].items():
+            lines.append(f'  {name:<24} {value:7d}')
+        return '\n'.join(lines)
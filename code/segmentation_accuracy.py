@@ -3,351 +3,147 @@
 #----------------------------------------------------------------------------#
 
 import os
+import csv
 import glob
 import numpy as np
-from PIL import Image
-import re
-from torchvision import transforms
-from sklearn.metrics import confusion_matrix
-import pandas as pd
-from sklearn.metrics import recall_score
-from sklearn.metrics import precision_score
+from concurrent.futures import ProcessPoolExecutor
+from species import load_species_table, flight_of
+from mask_cache import GroundTruthCache, read_binary_mask
+from mask_format import read_mask
 
 #----------------------------------------------------------------------------#
-# functions
-#----------------------------------------------------------------------------#
-
-def compute_iou(y_pred, y_true):
-     y_pred = y_pred.flatten()
-     y_true = y_true.flatten()
-     current = confusion_matrix(y_true, y_pred, labels=[0,250])
-     intersection = np.diag(current)
-     ground_truth_set = current.sum(axis=1)
-     predicted_set = current.sum(axis=0)
-     union = ground_truth_set + predicted_set - intersection
-     IoU = intersection / union.astype(np.float32)
-     return np.nanmean(IoU)
-
-def compute_recall(y_pred, y_true):
-     y_pred = y_pred.flatten()
-     y_true = y_true.flatten()
-     y_pred = (y_pred.cpu().numpy()).astype(int)
-     y_true = (y_true.cpu().numpy()).astype(int)
-     y_pred = (y_pred > 0).astype(int)  
-     y_true = (y_true > 0).astype(int) 
-     recall = recall_score(y_true, y_pred)
-     return (recall)
-
-def compute_precision(y_pred, y_true):
-     y_pred = y_pred.flatten()
-     y_true = y_true.flatten()
-     y_pred = (y_pred.cpu().numpy()).astype(int)
-     y_true = (y_true.cpu().numpy()).astype(int)
-     y_pred = (y_pred > 0).astype(int)  
-     y_true = (y_true > 0).astype(int) 
-     precision = precision_score(y_true, y_pred)
-     return (precision)
-
-#----------------------------------------------------------------------------#
-# Centaurea cyanus
-#----------------------------------------------------------------------------#
-
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Centaurea/')
-masks = glob.glob('*.png.tiff')
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Centaurea/')
-ground_truth = os.listdir()
-
-d = []
-for file in (masks):
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Centaurea/')
-    mask_file = Image.open(file)
-    number = re.search('plot_(.*)_flight', file)
-    number = number.group(1)
-    height = re.search('_X(.*).png', file)
-    height = height.group(1)
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Centaurea/')
-    ground_truth_file = 'plot_'+number+"_flight_X10.tiff"
-    ground_truth_file = Image.open(ground_truth_file)
-    convert_tensor = transforms.ToTensor()
-    ground_truth_tensor = convert_tensor(ground_truth_file)
-    mask_tensor = convert_tensor(mask_file)
-    iou = compute_iou(mask_tensor,ground_truth_tensor)
-    recall = compute_recall(mask_tensor,ground_truth_tensor)
-    precision = compute_precision(mask_tensor,ground_truth_tensor)
-
-    d.append(
-          {
-          'IoU': iou,
-          'precision': precision,
-          'recall': recall,
-          'plot': file,
-          'species':  'Centaurea cyanus',
-          'height' : height
-          }
-        )
-
-    print(file)
-
-Centaurea = pd.DataFrame(d)
-
-#----------------------------------------------------------------------------#
-# Cirsium arvense
-#----------------------------------------------------------------------------#
-
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Cirsium/')
-masks = glob.glob('*.png.tiff')
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Cirsium/')
-ground_truth = os.listdir()
-
-d = []
-for file in (masks):
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Cirsium/')
-    mask_file = Image.open(file)
-    number = re.search('plot_(.*)_flight', file)
-    number = number.group(1)
-    height = re.search('_X(.*).png', file)
-    height = height.group(1)
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Cirsium/')
-    ground_truth_file = 'plot_'+number+"_flight_X10.tiff"
-    ground_truth_file = Image.open(ground_truth_file)
-    convert_tensor = transforms.ToTensor()
-    ground_truth_tensor = convert_tensor(ground_truth_file)
-    mask_tensor = convert_tensor(mask_file)
-    iou = compute_iou(mask_tensor,ground_truth_tensor)
-    recall = compute_recall(mask_tensor,ground_truth_tensor)
-    precision = compute_precision(mask_tensor,ground_truth_tensor)
-
-    d.append(
-          {
-          'IoU': iou,
-          'precision': precision,
-          'recall': recall,
-          'plot': file,
-          'species':  'Cirsium arvense',
-          'height' : height
-          }
-        )
-
-    print(file)
-
-Cirsium = pd.DataFrame(d)
-
-#----------------------------------------------------------------------------#
-# Anchusa arvensis
-#----------------------------------------------------------------------------#
-
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Anchusa/')
-masks = glob.glob('*.png.tiff')
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Anchusa/')
-ground_truth = os.listdir()
-
-d = []
-for file in (masks):
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Anchusa/')
-    mask_file = Image.open(file)
-    number = re.search('plot_(.*)_flight', file)
-    number = number.group(1)
-    height = re.search('_X(.*).png', file)
-    height = height.group(1)
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Anchusa/')
-    ground_truth_file = 'plot_'+number+"_flight_X10.tiff"
-    ground_truth_file = Image.open(ground_truth_file)
-    convert_tensor = transforms.ToTensor()
-    ground_truth_tensor = convert_tensor(ground_truth_file)
-    mask_tensor = convert_tensor(mask_file)
-    iou = compute_iou(mask_tensor,ground_truth_tensor)
-    recall = compute_recall(mask_tensor,ground_truth_tensor)
-    precision = compute_precision(mask_tensor,ground_truth_tensor)
-
-    d.append(
-          {
-          'IoU': iou,
-          'precision': precision,
-          'recall': recall,
-          'plot': file,
-          'species':  'Anchusa arvensis',
-          'height' : height
-          }
-        )
-
-    print(file)
-
-Anchusa = pd.DataFrame(d)
-
-#----------------------------------------------------------------------------#
-# Equisetum arvense
+# settings
 #----------------------------------------------------------------------------#
 
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Equisetum/')
-masks = glob.glob('*.png.tiff')
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Equisetum/')
-ground_truth = os.listdir()
-
-d = []
-for file in (masks):
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Equisetum/')
-    mask_file = Image.open(file)
-    number = re.search('plot_(.*)_flight', file)
-    number = number.group(1)
-    height = re.search('_X(.*).png', file)
-    height = height.group(1)
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Equisetum/')
-    ground_truth_file = 'plot_'+number+"_flight_X10.tiff"
-    ground_truth_file = Image.open(ground_truth_file)
-    convert_tensor = transforms.ToTensor()
-    ground_truth_tensor = convert_tensor(ground_truth_file)
-    mask_tensor = convert_tensor(mask_file)
-    iou = compute_iou(mask_tensor,ground_truth_tensor)
-    recall = compute_recall(mask_tensor,ground_truth_tensor)
-    precision = compute_precision(mask_tensor,ground_truth_tensor)
-
-    d.append(
-          {
-          'IoU': iou,
-          'precision': precision,
-          'recall': recall,
-          'plot': file,
-          'species':  'Equisetum arvense',
-          'height' : height
-          }
-        )
+path_to_predictions = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/"
+path_to_masks = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/"
+path_to_output = "/zenodo/CBarrasso/UAV_SegetalFlora/data/YOLO_segmentation_accuracy.csv"
+workers = os.cpu_count()
+cache_bytes = 512 * 2**20  # ground-truth cache budget per worker
+path_to_cache = None       # optional folder for memory-mapped ground truths
 
-    print(file)
-
-Equisetum = pd.DataFrame(d)
-
-#----------------------------------------------------------------------------#
-# Tripleurospermum inodorum
-#----------------------------------------------------------------------------#
-
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Tripleurospermum/')
-masks = glob.glob('*.png.tiff')
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Tripleurospermum/')
-ground_truth = os.listdir()
-
-d = []
-for file in (masks):
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Tripleurospermum/')
-    mask_file = Image.open(file)
-    number = re.search('plot_(.*)_flight', file)
-    number = number.group(1)
-    height = re.search('_X(.*).png', file)
-    height = height.group(1)
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Tripleurospermum/')
-    ground_truth_file = 'plot_'+number+"_flight_X10.tiff"
-    ground_truth_file = Image.open(ground_truth_file)
-    convert_tensor = transforms.ToTensor()
-    ground_truth_tensor = convert_tensor(ground_truth_file)
-    mask_tensor = convert_tensor(mask_file)
-    iou = compute_iou(mask_tensor,ground_truth_tensor)
-    recall = compute_recall(mask_tensor,ground_truth_tensor)
-    precision = compute_precision(mask_tensor,ground_truth_tensor)
-
-    d.append(
-          {
-          'IoU': iou,
-          'precision': precision,
-          'recall': recall,
-          'plot': file,
-          'species':  'Tripleurospermum inodorum',
-          'height' : height
-          }
-        )
-
-    print(file)
-
-Tripleurospermum = pd.DataFrame(d)
-
-#----------------------------------------------------------------------------#
-# Papaver dubium
 #----------------------------------------------------------------------------#
-
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Papaver/')
-masks = glob.glob('*.png.tiff')
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Papaver/')
-ground_truth = os.listdir()
-
-d = []
-for file in (masks):
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Papaver/')
-    mask_file = Image.open(file)
-    number = re.search('plot_(.*)_flight', file)
-    number = number.group(1)
-    height = re.search('_X(.*).png', file)
-    height = height.group(1)
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Papaver/')
-    ground_truth_file = 'plot_'+number+"_flight_X10.tiff"
-    ground_truth_file = Image.open(ground_truth_file)
-    convert_tensor = transforms.ToTensor()
-    ground_truth_tensor = convert_tensor(ground_truth_file)
-    mask_tensor = convert_tensor(mask_file)
-    iou = compute_iou(mask_tensor,ground_truth_tensor)
-    recall = compute_recall(mask_tensor,ground_truth_tensor)
-    precision = compute_precision(mask_tensor,ground_truth_tensor)
-
-    d.append(
-          {
-          'IoU': iou,
-          'precision': precision,
-          'recall': recall,
-          'plot': file,
-          'species':  'Papaver dubium',
-          'height' : height
-          }
-        )
-
-    print(file)
-
-Papaver = pd.DataFrame(d)
-
-#----------------------------------------------------------------------------#
-# Vicia
+# functions
 #----------------------------------------------------------------------------#
 
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Vicia/')
-masks = glob.glob('*.png.tiff')
-os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Vicia/')
-ground_truth = os.listdir()
-
-d = []
-for file in (masks):
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/Vicia/')
-    mask_file = Image.open(file)
-    number = re.search('plot_(.*)_flight', file)
-    number = number.group(1)
-    height = re.search('_X(.*).png', file)
-    height = height.group(1)
-    os.chdir('/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/Vicia/')
-    ground_truth_file = 'plot_'+number+"_flight_X10.tiff"
-    ground_truth_file = Image.open(ground_truth_file)
-    convert_tensor = transforms.ToTensor()
-    ground_truth_tensor = convert_tensor(ground_truth_file)
-    mask_tensor = convert_tensor(mask_file)
-    iou = compute_iou(mask_tensor,ground_truth_tensor)
-    recall = compute_recall(mask_tensor,ground_truth_tensor)
-    precision = compute_precision(mask_tensor,ground_truth_tensor)
-
-    d.append(
-          {
-          'IoU': iou,
-          'precision': precision,
-          'recall': recall,
-          'plot': file,
-          'species':  'Vicia',
-          'height' : height
-          }
-        )
-
-    print(file)
-
-Vicia = pd.DataFrame(d)
+# binary masks (foreground = value > 0): the 2x2 confusion counts are taken
+# with bitwise ops in a single pass, and IoU (mean over background and
+# foreground, as the former confusion_matrix based mIoU), precision and
+# recall are derived from them
+def confusion_counts(y_pred, y_true):
+     y_pred = np.asarray(y_pred).reshape(-1) > 0
+     y_true = np.asarray(y_true).reshape(-1) > 0
+     tp = np.count_nonzero(y_pred & y_true)
+     fp = np.count_nonzero(y_pred) - tp
+     fn = np.count_nonzero(y_true) - tp
+     tn = y_true.size - tp - fp - fn
+     return tp, fp, fn, tn
+
+def metrics_from_counts(tp, fp, fn, tn):
+     with np.errstate(divide='ignore', invalid='ignore'):
+          IoU = np.array([tn, tp]) / np.array([tn + fp + fn, tp + fp + fn], dtype=np.float64)
+     precision = tp / (tp + fp) if tp + fp else 0.0
+     recall = tp / (tp + fn) if tp + fn else 0.0
+     return {'IoU': np.nanmean(IoU) if not np.isnan(IoU).all() else np.nan,
+             'precision': precision, 'recall': recall,
+             'TP': tp, 'FP': fp, 'FN': fn, 'TN': tn}
+
+def compute_metrics(y_pred, y_true):
+     return metrics_from_counts(*confusion_counts(y_pred, y_true))
+
+#----------------------------------------------------------------------------#
+# evaluation jobs: one per (species, plot, height), absolute paths only so
+# they can run in any worker process
+#----------------------------------------------------------------------------#
+
+def evaluation_jobs(species_table, path_to_predictions, path_to_masks):
+     jobs = []
+     for row in species_table:
+          files = sorted(glob.glob(os.path.join(path_to_predictions, row['prefix'], '*.png.tiff'))
+                         + glob.glob(os.path.join(path_to_predictions, row['prefix'], '*.sfm')))
+          for path in files:
+               file = os.path.basename(path)
+               number, height = flight_of(file)
+               ground_truth_file = os.path.join(path_to_masks, row['prefix'], 'plot_'+number+"_flight_X10.tiff")
+               jobs.append({'species': row['species'], 'prediction': path,
+                            'ground_truth': ground_truth_file, 'plot': file, 'height': height})
+     return jobs
+
+# one cache per worker process, jobs sharing a ground truth run in the same
+# worker so each mask is decoded once for all heights
+ground_truth_cache = None
+
+def init_worker(max_bytes, cache_dir):
+     global ground_truth_cache
+     ground_truth_cache = GroundTruthCache(max_bytes, cache_dir)
+
+# boolean (height, width) masks: .sfm predictions read exactly (without the
+# letterbox padding of the grid they were predicted on), images
+# binarised at > 0 as the ground truth
+def read_prediction(path):
+     if path.endswith('.sfm'):
+          return read_mask(path)
+     return read_binary_mask(path)
+
+def evaluate_jobs(jobs):
+     if ground_truth_cache is None:
+          init_worker(cache_bytes, path_to_cache)
+     masks = [read_prediction(job['prediction']) for job in jobs]
+     ground_truth_cache.precompute(jobs[0]['ground_truth'], {tuple(mask.shape[-2:]) for mask in masks})
+     d = []
+     for job, mask in zip(jobs, masks):
+          ground_truth = ground_truth_cache.get(job['ground_truth'], mask.shape[-2:])
+          metrics = compute_metrics(mask, ground_truth)
+          d.append({
+               'IoU': metrics['IoU'],
+               'precision': metrics['precision'],
+               'recall': metrics['recall'],
+               'plot': job['plot'],
+               'species': job['species'],
+               'height': job['height']
+               })
+     return d
+
+ACCURACY_COLUMNS = ['IoU', 'precision', 'recall', 'plot', 'species', 'height']
+
+# fans the jobs out over a process pool and returns the rows (dicts with
+# ACCURACY_COLUMNS) grouped by species, in the order of the species table
+def run_evaluation(species_table, path_to_predictions, path_to_masks, workers=None,
+                   cache_bytes=cache_bytes, path_to_cache=path_to_cache):
+     jobs = evaluation_jobs(species_table, path_to_predictions, path_to_masks)
+     groups = {}
+     for job in jobs:
+          groups.setdefault(job['ground_truth'], []).append(job)
+     workers = workers or os.cpu_count()
+     chunksize = max(1, len(groups) // (workers * 4))
+     d = []
+     with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                              initargs=(cache_bytes, path_to_cache)) as pool:
+          for rows in pool.map(evaluate_jobs, groups.values(), chunksize=chunksize):
+               for row in rows:
+                    d.append(row)
+                    print(row['plot'])
+     return [r for row in species_table for r in d if r['species'] == row['species']]
+
+# same layout as the former pandas table: a leading unnamed index column
+# that restarts at 0 for every species, NaN written as an empty field
+def csv_value(value):
+     return '' if isinstance(value, float) and np.isnan(value) else value
+
+def write_accuracy(rows, path):
+     with open(path, 'w', newline='') as f:
+          writer = csv.writer(f, lineterminator='\n')
+          writer.writerow([''] + ACCURACY_COLUMNS)
+          index = {}
+          for row in rows:
+               index[row['species']] = index.get(row['species'], -1) + 1
+               writer.writerow([index[row['species']]] + [csv_value(row[column]) for column in ACCURACY_COLUMNS])
 
 #----------------------------------------------------------------------------#
 # save file
 #----------------------------------------------------------------------------#
 
-frames = [Centaurea, Equisetum, Vicia, Tripleurospermum, Papaver, Cirsium, Anchusa]
-result = pd.concat(frames)
-result.to_csv("/zenodo/CBarrasso/UAV_SegetalFlora/data/YOLO_segmentation_accuracy.csv")
-
-
+if __name__ == '__main__':
+     result = run_evaluation(load_species_table(), path_to_predictions, path_to_masks, workers,
+                             cache_bytes, path_to_cache)
+     write_accuracy(result, path_to_output)
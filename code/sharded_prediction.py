@@ -0,0 +1,124 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from species import load_species_table
+from prediction_engine import list_tiles
+from manifest import Manifest
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+path_to_tiles = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/"
+path_to_predictions = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/"
+species_table = load_species_table()
+processes = 4                                  # worker processes, each with its own models
+threads = max(1, os.cpu_count() // processes)  # torch threads per worker
+pin = True                                     # give every worker its own cores
+mask_format = 'sfm'
+path_to_manifest = path_to_predictions + "manifest.jsonl"  # one shard file per worker, merged at the end
+path_to_instances = None                       # e.g. path_to_predictions + "instances.parquet", one file per worker
+layouts = None       # e.g. [(1, 16), (2, 8), (4, 4), (8, 2), (16, 1)]: (processes, threads) to compare
+layout_tiles = 32    # tiles each layout is timed on
+
+#----------------------------------------------------------------------------#
+# sharded prediction on CPU nodes: the tile list is dealt round-robin to
+# N spawned worker processes, each loading its own copy of the models with a
+# fixed torch thread budget (and, with pin, its own set of cores). Every
+# tile belongs to one shard, so outputs never collide; the manifest gets one
+# shard file per worker, merged when the run ends.
+#----------------------------------------------------------------------------#
+
+def shard_tiles(tiles, shards):
+    return [tiles[i::shards] for i in range(shards)]
+
+def worker_cores(shard, threads):
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    if (shard + 1) * threads > len(cores):
+        return None
+    return cores[shard * threads:(shard + 1) * threads]
+
+def run_shard(shard, tiles, species_table, path_to_predictions, threads, cores, options):
+    if cores:
+        os.sched_setaffinity(0, cores)
+    import cv2
+    import torch
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(1)
+    from prediction_engine import predict_tiles
+    start = time.perf_counter()
+    report = predict_tiles(tiles, species_table, path_to_predictions, shard=shard, **options)
+    return {'shard': shard, 'threads': threads, 'cores': cores, 'tiles': len(tiles),
+            'predicted': report['tiles'], 'elapsed_s': time.perf_counter() - start,
+            'model_load_s': report['stages'].get('model load', {}).get('total_s', 0.0),
+            'throughput_images_s': report['throughput_images_s']}
+
+# per-worker results plus the aggregate throughput over the wall-clock
+# time of the whole run, worker start-up included
+def predict_sharded(tiles, species_table, path_to_predictions, processes=4, threads=1, pin=True,
+                    path_to_manifest=None, path_to_instances=None, **options):
+    if path_to_manifest:
+        os.makedirs(os.path.dirname(path_to_manifest) or '.', exist_ok=True)
+        Manifest(path_to_manifest).close()  # merges shards left by an interrupted run
+    context = multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        futures = []
+        for shard, part in enumerate(shard_tiles(tiles, processes)):
+            instances = path_to_instances and f'{os.path.splitext(path_to_instances)[0]}_shard{shard}.parquet'
+            futures.append(pool.submit(run_shard, shard, part, species_table, path_to_predictions, threads,
+                                       worker_cores(shard, threads) if pin else None,
+                                       dict(options, path_to_manifest=path_to_manifest, path_to_instances=instances,
+                                            workers=options.get('workers', 2))))
+        workers = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    if path_to_manifest:
+        Manifest(path_to_manifest).close()
+    predicted = sum(worker['predicted'] for worker in workers)
+    return {'processes': processes, 'threads': threads, 'tiles': predicted, 'elapsed_s': elapsed,
+            'throughput_images_s': predicted / elapsed if elapsed else float('nan'), 'workers': workers}
+
+def print_workers(run):
+    print(f"{'shard':>6}{'threads':>9}{'tiles':>7}{'model load s':>14}{'elapsed s':>11}{'images/s':>10}")
+    for worker in run['workers']:
+        print(f"{worker['shard']:>6}{worker['threads']:>9}{worker['predicted']:>7}{worker['model_load_s']:>14.1f}"
+              f"{worker['elapsed_s']:>11.1f}{worker['throughput_images_s']:>10.2f}")
+    print(f"{run['processes']} x {run['threads']}: {run['tiles']} tiles in {run['elapsed_s']:.1f} s, "
+          f"{run['throughput_images_s']:.2f} images/s")
+
+# the same tiles under every (processes, threads) layout, each into a fresh
+# folder; efficiency is throughput per core relative to the first layout
+def compare_layouts(tiles, species_table, path_to_predictions, layouts, pin=True, **options):
+    runs = []
+    for processes, threads in layouts:
+        folder = os.path.join(path_to_predictions, f'layout_{processes}x{threads}')
+        runs.append(predict_sharded(tiles, species_table, folder, processes, threads, pin, **options))
+    reference = runs[0]['throughput_images_s'] / (layouts[0][0] * layouts[0][1])
+    print(f"{'processes':>10}{'threads':>9}{'cores':>7}{'images/s':>10}{'per core':>10}{'efficiency':>12}")
+    for run in runs:
+        cores = run['processes'] * run['threads']
+        per_core = run['throughput_images_s'] / cores
+        print(f"{run['processes']:>10}{run['threads']:>9}{cores:>7}{run['throughput_images_s']:>10.2f}"
+              f"{per_core:>10.3f}{per_core / reference:>12.0%}")
+    return runs
+
+#----------------------------------------------------------------------------#
+# model predict
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    tiles = list_tiles(path_to_tiles)
+    if layouts:
+        compare_layouts(tiles[:layout_tiles], species_table, os.path.join(path_to_predictions, 'layouts'), layouts,
+                        pin, mask_format=mask_format, save_annotated=False)
+    else:
+        run = predict_sharded(tiles, species_table, path_to_predictions, processes, threads, pin,
+                              path_to_manifest, path_to_instances, mask_format=mask_format)
+        print_workers(run)
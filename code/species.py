@@ -0,0 +1,27 @@
+#----------------------------------------------------------------------------#
+# species table shared by the prediction and accuracy scripts
+#----------------------------------------------------------------------------#
+
+import os
+import re
+import csv
+
+SPECIES_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'species.csv')
+
+# one row per species: name used in the accuracy table, prefix of the
+# prediction/mask folders and files, trained model and confidence threshold
+def load_species_table(path=SPECIES_TABLE, select=None):
+    with open(path, newline='') as f:
+        table = [dict(row, conf=float(row['conf'])) for row in csv.DictReader(f)]
+    if select is None:
+        return table
+    unknown = set(select) - {row['prefix'] for row in table}
+    if unknown:
+        raise ValueError('unknown species prefix: ' + ', '.join(sorted(unknown)))
+    return [row for row in table if row['prefix'] in select]
+
+# plot number and flight height from file names such as
+# plot_26_flight_X10.png, None for names that do not follow the pattern
+def flight_of(name):
+    match = re.search('plot_(.*)_flight_X([0-9]+)', os.path.basename(name))
+    return (match.group(1), match.group(2)) if match else (None, None)
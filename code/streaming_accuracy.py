@@ -0,0 +1,153 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import csv
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from species import load_species_table, flight_of
+from mask_cache import GroundTruthCache
+from mask_format import read_header, header_window, iter_mask_rows
+from segmentation_accuracy import evaluation_jobs, read_prediction, confusion_counts, metrics_from_counts
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+path_to_predictions = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/"
+path_to_masks = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/"
+path_to_output = "/zenodo/CBarrasso/UAV_SegetalFlora/data/YOLO_segmentation_accuracy_pooled.csv"
+path_to_management = None  # optional csv with plot,management; else plots 26-35 extensive as in analysis.R
+rows = 256                 # mask rows compared at a time
+workers = os.cpu_count()
+cache_bytes = 64 * 2**20   # ground-truth cache budget per worker
+path_to_cache = None       # optional folder for memory-mapped ground truths
+
+#----------------------------------------------------------------------------#
+# streaming evaluation: each prediction is compared with its ground truth
+# a chunk of rows at a time, .sfm predictions decoded chunk by chunk from
+# their memory-mapped payload and ground truths unpacked row range by row
+# range from the bit-packed cache, so a worker holds a few chunks plus the
+# cache budget. Only integer confusion counts leave the workers; they are
+# pooled per group into micro (pooled counts) and macro (mean over images)
+# IoU, precision and recall, with the definitions of segmentation_accuracy.py
+#----------------------------------------------------------------------------#
+
+GROUPINGS = [('species',), ('species', 'height'), ('species', 'management'),
+             ('species', 'height', 'management'), ('species', 'plot')]
+KEYS = ['species', 'height', 'management', 'plot']
+METRICS = ['IoU', 'precision', 'recall']
+
+def load_management(path):
+    with open(path, newline='') as f:
+        return {row['plot']: row['management'] for row in csv.DictReader(f)}
+
+def management_of(plot, management=None):
+    if management is not None:
+        return management.get(plot, 'unknown')
+    return 'extensive' if 25 < int(plot) < 36 else 'intensive'
+
+# (height, width) and (first row, bool rows) chunks of a prediction, .sfm
+# masks without their letterbox padding; images have no random row access
+# and are read whole, then chunked
+def prediction_chunks(path, rows=256):
+    if path.endswith('.sfm'):
+        return tuple(header_window(read_header(path)[0])[2:]), iter_mask_rows(path, rows)
+    mask = read_prediction(path)
+    return mask.shape, ((start, mask[start:start + rows]) for start in range(0, mask.shape[0], rows))
+
+ground_truth_cache = None
+
+def init_worker(max_bytes, cache_dir):
+    global ground_truth_cache
+    ground_truth_cache = GroundTruthCache(max_bytes, cache_dir)
+
+def count_job(job, rows=256):
+    shape, chunks = prediction_chunks(job['prediction'], rows)
+    counts = np.zeros(4, dtype=np.int64)
+    for start, chunk in chunks:
+        counts += confusion_counts(chunk, ground_truth_cache.rows(job['ground_truth'], shape, start, start + len(chunk)))
+    return counts
+
+# jobs sharing a ground truth, as in segmentation_accuracy.py
+def count_jobs(jobs, rows=256):
+    if ground_truth_cache is None:
+        init_worker(cache_bytes, path_to_cache)
+    return [dict(job, counts=count_job(job, rows)) for job in jobs]
+
+def pooled_counts(species_table, path_to_predictions, path_to_masks, rows=256, workers=None,
+                  cache_bytes=cache_bytes, path_to_cache=path_to_cache):
+    groups = {}
+    for job in evaluation_jobs(species_table, path_to_predictions, path_to_masks):
+        groups.setdefault(job['ground_truth'], []).append(job)
+    workers = workers or os.cpu_count()
+    chunksize = max(1, len(groups) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(cache_bytes, path_to_cache)) as pool:
+        for results in pool.map(count_jobs, groups.values(), [rows] * len(groups), chunksize=chunksize):
+            yield from results
+
+#----------------------------------------------------------------------------#
+# aggregation: one row per group of every grouping, 'all' in the columns a
+# grouping pools over
+#----------------------------------------------------------------------------#
+
+def pooled_accuracy(species_table, results, management=None):
+    groups = {}
+    for result in results:
+        plot, height = flight_of(result['plot'])
+        keys = {'species': result['species'], 'height': height, 'plot': plot,
+                'management': management_of(plot, management)}
+        image = metrics_from_counts(*result['counts'])
+        for grouping in GROUPINGS:
+            key = tuple(keys[name] if name in grouping else 'all' for name in KEYS)
+            group = groups.setdefault(key, {'counts': np.zeros(4, dtype=np.int64), 'images': 0,
+                                            'sums': dict.fromkeys(METRICS, 0.0)})
+            group['counts'] += result['counts']
+            group['images'] += 1
+            for metric in METRICS:
+                group['sums'][metric] += image[metric]
+    order = {row['species']: i for i, row in enumerate(species_table)}
+    table = []
+    for key in sorted(groups, key=lambda key: (order[key[0]], [str(value) for value in key[1:]])):
+        group = groups[key]
+        pooled = metrics_from_counts(*group['counts'].tolist())
+        row = dict(zip(KEYS, key), images=group['images'],
+                   **dict(zip(['TP', 'FP', 'FN', 'TN'], group['counts'].tolist())))
+        for metric in METRICS:
+            row['micro_' + metric] = pooled[metric]
+            row['macro_' + metric] = group['sums'][metric] / group['images']
+        table.append(row)
+    return table
+
+def write_pooled(table, path):
+    columns = KEYS + ['images', 'TP', 'FP', 'FN', 'TN'] + [kind + '_' + metric for metric in METRICS
+                                                           for kind in ['micro', 'macro']]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(table)
+
+# the README table: mean mIoU per species and management over all heights
+def print_management_table(table):
+    rows = [row for row in table if row['height'] == 'all' and row['plot'] == 'all' and row['management'] != 'all']
+    kinds = sorted({row['management'] for row in rows})
+    print(f"{'species':<28}" + ''.join(f'{kind + " macro/micro":>24}' for kind in kinds))
+    for species in dict.fromkeys(row['species'] for row in rows):
+        values = {row['management']: row for row in rows if row['species'] == species}
+        print(f'{species:<28}' + ''.join(f"{values[kind]['macro_IoU']:>16.3f}/{values[kind]['micro_IoU']:.3f}"
+                                         if kind in values else f"{'':>24}" for kind in kinds))
+
+#----------------------------------------------------------------------------#
+# save file
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    species_table = load_species_table()
+    management = load_management(path_to_management) if path_to_management else None
+    results = pooled_counts(species_table, path_to_predictions, path_to_masks, rows, workers,
+                            cache_bytes, path_to_cache)
+    table = pooled_accuracy(species_table, results, management)
+    write_pooled(table, path_to_output)
+    print_management_table(table)
@@ -0,0 +1,174 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import csv
+import numpy as np
+import torch
+from species import load_species_table, flight_of
+from prediction_engine import list_tiles, prefetch_tiles, batch_tiles, load_models
+from mask_cache import GroundTruthCache
+from mask_format import mask_window
+from segmentation_accuracy import metrics_from_counts
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+path_to_tiles = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/"
+path_to_masks = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/"
+path_to_scores = "/zenodo/CBarrasso/UAV_SegetalFlora/data/threshold_sweep/"  # one score map per tile and species
+path_to_output = "/zenodo/CBarrasso/UAV_SegetalFlora/data/threshold_sweep.csv"
+species_table = load_species_table()
+floor_conf = 0.001   # inference threshold of the single pass, lowest threshold that can be swept
+thresholds = np.round(np.arange(0.01, 1.0, 0.01), 2)
+imgsz = 864
+batch_size = 8
+decode_workers = 4
+
+#----------------------------------------------------------------------------#
+# score maps: a single inference pass at floor_conf per tile and species.
+# The union mask at any threshold t >= floor_conf is the set of pixels
+# covered by a species instance with confidence > t (the ultralytics
+# filter; NMS only lets higher-scoring boxes suppress lower ones, so the
+# instances kept above t are the same as in a run at t). Each pixel
+# therefore only needs the rank of the best instance covering it: stored
+# are the instance confidences in descending order and a rank map (0 where
+# no instance, 1 for the best one, ...) on the part of the mask grid
+# covering the tile (without the letterbox padding), compressed .npz
+#----------------------------------------------------------------------------#
+
+def score_path(path_to_scores, row, tile):
+    return os.path.join(path_to_scores, row['prefix'], os.path.basename(tile) + '.npz')
+
+# instances are painted from the lowest to the highest confidence, so each
+# pixel keeps the best one covering it, with a single (h, w) buffer
+def rank_map(result, source_shape):
+    shape = tuple(result.masks.data.shape[1:]) if result.masks is not None else tuple(result.orig_shape)
+    top, left, height, width = mask_window(source_shape, shape)
+    if result.masks is None or not (result.boxes.cls == 0).any():
+        return np.zeros((height, width), dtype=np.uint16), np.zeros(0, dtype=np.float32)
+    species = torch.nonzero(result.boxes.cls == 0).flatten()
+    conf, order = torch.sort(result.boxes.conf[species], descending=True)
+    masks = result.masks.data[:, top:top + height, left:left + width]
+    ranks = torch.zeros((height, width), dtype=torch.int16, device=masks.device)
+    for rank in range(len(conf), 0, -1):
+        ranks.masked_fill_(masks[species[order[rank - 1]]] > 0, rank)
+    return ranks.cpu().numpy().astype(np.uint16), conf.cpu().numpy().astype(np.float32)
+
+def write_scores(path, ranks, conf, floor_conf):
+    tmp = path + '.tmp.npz'
+    np.savez_compressed(tmp, ranks=ranks, conf=conf, floor_conf=floor_conf, cropped=True)
+    os.replace(tmp, path)
+
+# score maps of earlier versions still hold the letterbox padding
+def scores_exist(path):
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as scores:
+        return 'cropped' in scores.files
+
+# tiles whose score maps exist are not predicted again, so later sweeps
+# need no model at all
+def build_scores(path_to_tiles, species_table, path_to_scores, floor_conf=0.001, imgsz=864, batch_size=8,
+                 workers=4):
+    for row in species_table:
+        os.makedirs(os.path.join(path_to_scores, row['prefix']), exist_ok=True)
+    missing = [tile for tile in list_tiles(path_to_tiles)
+               if not all(scores_exist(score_path(path_to_scores, row, tile)) for row in species_table)]
+    print(f'{len(missing)} tiles to predict at conf {floor_conf}')
+    if not missing:
+        return
+    models = load_models(species_table)
+    for batch in batch_tiles(prefetch_tiles(missing, imgsz, workers), batch_size):
+        x = torch.cat([tensor for _, tensor, _ in batch])
+        for row, model in models:
+            results = model.predict(source=x, imgsz=imgsz, conf=floor_conf, verbose=False)
+            for (path, _, shape), result in zip(batch, results):
+                write_scores(score_path(path_to_scores, row, path), *rank_map(result, shape), floor_conf)
+
+#----------------------------------------------------------------------------#
+# sweep: per image, the confusion counts of every threshold at once from
+# histograms of the ranks over the ground-truth foreground and over all
+# pixels; instances above t are the first k(t) ranks
+#----------------------------------------------------------------------------#
+
+def threshold_counts(ranks, conf, ground_truth, thresholds):
+    n = len(conf)
+    foreground = np.bincount(ranks[ground_truth], minlength=n + 1)
+    predicted = np.bincount(ranks.reshape(-1), minlength=n + 1)
+    k = np.searchsorted(-conf, -np.asarray(thresholds, dtype=np.float32), side='left')
+    tp = np.concatenate(([0], np.cumsum(foreground[1:])))[k]
+    positive = np.concatenate(([0], np.cumsum(predicted[1:])))[k]
+    fp = positive - tp
+    fn = int(foreground.sum()) - tp
+    tn = ranks.size - tp - fp - fn
+    return np.stack([tp, fp, fn, tn], axis=1)
+
+# one row per species, height ('all' pooled over heights) and threshold:
+# macro (mean per image, as segmentation_accuracy.py) and micro (pooled)
+# IoU, precision and recall
+def sweep(species_table, path_to_scores, path_to_masks, thresholds):
+    cache = GroundTruthCache()
+    table = []
+    for row in species_table:
+        folder = os.path.join(path_to_scores, row['prefix'])
+        groups = {}
+        for name in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+            plot, height = flight_of(name)
+            ground_truth = os.path.join(path_to_masks, row['prefix'], 'plot_' + str(plot) + '_flight_X10.tiff')
+            if plot is None or not os.path.exists(ground_truth):
+                continue
+            with np.load(os.path.join(folder, name)) as scores:
+                ranks, conf = scores['ranks'], scores['conf']
+                if 'cropped' not in scores.files:
+                    raise ValueError(f'{name} holds the letterbox padding, rebuild it with build_scores')
+                if thresholds.min() < scores['floor_conf']:
+                    raise ValueError(f'{name} was predicted at conf {scores["floor_conf"]}, '
+                                     f'above the lowest threshold {thresholds.min()}')
+            counts = threshold_counts(ranks, conf, cache.get(ground_truth, ranks.shape), thresholds)
+            image = [metrics_from_counts(*map(int, c)) for c in counts]
+            for key in [height, 'all']:
+                group = groups.setdefault(key, {'counts': 0, 'images': 0, 'sums': np.zeros((len(thresholds), 3))})
+                group['counts'] = group['counts'] + counts
+                group['images'] += 1
+                group['sums'] += [[m['IoU'], m['precision'], m['recall']] for m in image]
+        for height in sorted(groups, key=lambda height: (height == 'all', int(height) if height != 'all' else 0)):
+            group = groups[height]
+            for t, counts, sums in zip(thresholds, group['counts'], group['sums']):
+                pooled = metrics_from_counts(*map(int, counts))
+                macro = sums / group['images']
+                table.append({'species': row['species'], 'height': height, 'conf': float(t),
+                              'images': group['images'], 'macro_IoU': macro[0], 'macro_precision': macro[1],
+                              'macro_recall': macro[2], 'micro_IoU': pooled['IoU'],
+                              'micro_precision': pooled['precision'], 'micro_recall': pooled['recall']})
+    return table
+
+def write_sweep(table, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, list(table[0]) if table else ['species'], lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(table)
+
+# best threshold per species by mean IoU over all heights, next to the
+# threshold in species.csv (nearest grid value)
+def print_best(species_table, table):
+    print(f"{'species':<28}{'conf':>8}{'IoU':>8}{'best conf':>12}{'IoU':>8}")
+    for row in species_table:
+        rows = [r for r in table if r['species'] == row['species'] and r['height'] == 'all']
+        if not rows:
+            continue
+        current = min(rows, key=lambda r: abs(r['conf'] - row['conf']))
+        best = max(rows, key=lambda r: r['macro_IoU'])
+        print(f"{row['species']:<28}{row['conf']:8.3f}{current['macro_IoU']:8.3f}{best['conf']:12.3f}{best['macro_IoU']:8.3f}")
+
+#----------------------------------------------------------------------------#
+# run
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    build_scores(path_to_tiles, species_table, path_to_scores, floor_conf, imgsz, batch_size, decode_workers)
+    table = sweep(species_table, path_to_scores, path_to_masks, thresholds)
+    write_sweep(table, path_to_output)
+    print_best(species_table, table)
@@ -0,0 +1,276 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import csv
+import time
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from species import load_species_table, flight_of
+from profiling import StageTimer
+from manifest import Manifest
+from async_writer import AsyncWriter
+from instance_records import letterbox_geometry, packed_count
+from prediction_engine import (IMAGE_SUFFIXES, load_tile, batch_tiles, load_models, MaskUnion, write_outputs,
+                               pending_predictions, close_outputs)
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+path_to_inbox = "/zenodo/CBarrasso/UAV_SegetalFlora/data/inbox/"  # where the drone images are copied to
+path_to_predictions = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/"
+path_to_counts = path_to_predictions + "plot_counts.csv"    # one line per image and species, as they finish
+path_to_manifest = path_to_predictions + "manifest.jsonl"   # a restarted watcher skips what is done
+species_table = load_species_table()
+imgsz = 864
+batch_size = 8       # at most; a batch is whatever is waiting, inference never waits for it to fill
+settle_s = 3.0       # an image is complete once its size and mtime have not changed for this long
+poll_s = 1.0
+queue_size = 16      # decoded images waiting for inference; when full, new images wait on disk
+decode_workers = 2
+write_workers = 2
+mask_format = 'sfm'
+save_annotated = False
+latency_target_s = 60.0  # end-to-end latency above which the status warns that inference falls behind
+status_s = 30.0
+idle_exit_s = None   # stop after this long without new images, None to run until interrupted
+
+#----------------------------------------------------------------------------#
+# watch folder: images are picked up once their size and modification time
+# have stayed the same for settle_s (a copy in progress keeps changing
+# them; names starting with '.' and other suffixes, e.g. .part, are
+# ignored), decoded by a small pool and put into a bounded queue. When
+# inference falls behind the queue fills and the watcher stops taking new
+# images, which wait on disk instead of in memory. Latency is measured
+# from the first time an image was seen to its last output written.
+#----------------------------------------------------------------------------#
+
+class FolderWatcher:
+
+    def __init__(self, path, settle_s=3.0):
+        self.path = path
+        self.settle_s = settle_s
+        self.changing = {}  # path: ((size, mtime_ns), first seen, last change)
+        self.taken = set()
+
+    # (path, first seen) of the images that became complete since the last poll
+    def poll(self):
+        now = time.time()
+        complete = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if (entry.name.startswith('.') or not entry.name.lower().endswith(IMAGE_SUFFIXES)
+                        or entry.path in self.taken):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                previous = self.changing.get(entry.path)
+                if previous is None or previous[0] != signature:
+                    self.changing[entry.path] = (signature, previous[1] if previous else now, now)
+                elif stat.st_size and now - previous[2] >= self.settle_s:
+                    self.taken.add(entry.path)
+                    complete.append((entry.path, self.changing.pop(entry.path)[1]))
+        return sorted(complete)
+
+class LatencyTracker:
+
+    def __init__(self, window=200):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.latencies = collections.deque(maxlen=window)
+        self.finished = 0
+        self.failed = 0
+
+    def start(self, path, seen, outputs):
+        with self.lock:
+            self.pending[path] = [outputs, seen, False]
+
+    # an image with a failed output counts as failed, not in the latencies
+    def done(self, path, failed=False):
+        with self.lock:
+            entry = self.pending[path]
+            entry[0] -= 1
+            entry[2] = entry[2] or failed
+            if not entry[0]:
+                if entry[2]:
+                    self.failed += 1
+                else:
+                    self.latencies.append(time.time() - entry[1])
+                    self.finished += 1
+                del self.pending[path]
+
+    # p50, p95 and max over the last `window` images
+    def percentiles(self):
+        with self.lock:
+            latencies = list(self.latencies)
+        return np.percentile(latencies, [50, 95, 100]) if latencies else [np.nan] * 3
+
+class PlotCounts:
+
+    COLUMNS = ['tile', 'plot', 'height', 'species', 'instances', 'cover_percent']
+
+    def __init__(self, path):
+        new = not os.path.exists(path) or not os.path.getsize(path)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file, lineterminator='\n')
+        if new:
+            self.writer.writerow(self.COLUMNS)
+
+    def add(self, tile_path, row, instances, cover_percent):
+        plot, height = flight_of(tile_path)
+        self.writer.writerow([tile_path, plot, height, row['species'], instances, f'{cover_percent:.4f}'])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def write_tracked(tracker, path, *args):
+    failed = True
+    try:
+        write_outputs(*args)
+        failed = False
+    finally:
+        tracker.done(path, failed)
+
+#----------------------------------------------------------------------------#
+# watcher thread: completed images still missing a species go to the decode
+# pool and the bounded queue
+#----------------------------------------------------------------------------#
+
+def watch(watcher, tiles, ready, models, manifest, pool, timer, stop):
+    while not stop.is_set():
+        ready.extend(watcher.poll())
+        while ready and not stop.is_set():
+            path, seen = ready[0]
+            pending = pending_predictions([path], models, imgsz, mask_format, manifest).get(path)
+            if pending is None:
+                ready.popleft()
+                continue
+            item = (path, seen, pending, pool.submit(load_tile, path, imgsz, timer))
+            while not stop.is_set():
+                try:
+                    tiles.put(item, timeout=poll_s)
+                    break
+                except queue.Full:
+                    continue
+            ready.popleft()
+        stop.wait(poll_s)
+
+# whatever is queued, at most batch_size, waiting only for the first image
+def next_batch(tiles, batch_size, timeout):
+    try:
+        batch = [tiles.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(batch) < batch_size:
+        try:
+            batch.append(tiles.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def print_status(tracker, tiles, ready, watcher, latency_target_s):
+    p50, p95, worst = tracker.percentiles()
+    print(f'{tracker.finished} images done, {tracker.failed} failed, {len(watcher.changing)} being copied, '
+          f'{len(ready)} waiting on disk, {tiles.qsize()} decoded, '
+          f'latency p50/p95/max {p50:.1f}/{p95:.1f}/{worst:.1f} s')
+    if p95 > latency_target_s:
+        print(f'latency above {latency_target_s:.0f} s: inference is falling behind the drone')
+
+#----------------------------------------------------------------------------#
+# inference loop
+#----------------------------------------------------------------------------#
+
+def watch_folder(path_to_inbox, species_table, path_to_predictions, path_to_counts=None, path_to_manifest=None):
+    timer = StageTimer()
+    with timer.stage('model load'):
+        models = load_models(species_table)
+    for row in species_table:
+        os.makedirs(os.path.join(path_to_predictions, row['prefix'], 'annotated' if save_annotated else ''),
+                    exist_ok=True)
+    manifest = Manifest(path_to_manifest) if path_to_manifest else None
+    counts = PlotCounts(path_to_counts) if path_to_counts else None
+    writer = AsyncWriter(write_workers, queue_size * len(models))
+    watcher = FolderWatcher(path_to_inbox, settle_s)
+    tracker = LatencyTracker()
+    tiles = queue.Queue(maxsize=queue_size)
+    ready = collections.deque()
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=decode_workers)
+    thread = threading.Thread(target=watch, args=(watcher, tiles, ready, models, manifest, pool, timer, stop),
+                              daemon=True)
+    thread.start()
+    union = MaskUnion()
+    last_image = last_status = time.time()
+    print(f'watching {path_to_inbox}')
+    failing = False
+    try:
+        while True:
+            if time.time() - last_status >= status_s:
+                print_status(tracker, tiles, ready, watcher, latency_target_s)
+                last_status = time.time()
+            batch = next_batch(tiles, batch_size, poll_s)
+            if not batch:
+                if idle_exit_s and time.time() - last_image >= idle_exit_s and not ready and not watcher.changing:
+                    break
+                continue
+            last_image = time.time()
+            loaded = []
+            for path, seen, pending, future in batch:
+                try:
+                    loaded.append(future.result())
+                except Exception as error:
+                    print(f'skipping {path}: {error!r}')
+                    continue
+                tracker.start(path, seen, sum(key is not None or manifest is None for key in pending))
+                loaded[-1] += (pending,)
+            for group in batch_tiles(loaded, batch_size):
+                x = torch.cat([tensor for _, tensor, _, _ in group])
+                for m, (row, model) in enumerate(models):
+                    todo = [tile for tile in group if manifest is None or tile[3][m]]
+                    if not todo:
+                        continue
+                    x_todo = x if len(todo) == len(group) else torch.cat([tensor for _, tensor, _, _ in todo])
+                    with timer.stage('inference', [path for path, _, _, _ in todo]):
+                        results = model.predict(source=x_todo, imgsz=imgsz, conf=row['conf'], verbose=False)
+                    for (path, _, shape, pending), result in zip(todo, results):
+                        with timer.stage('postprocess', [path]):
+                            packed, mask_shape = union(result)
+                            if counts:
+                                geometry = letterbox_geometry(shape, imgsz)
+                                instances = 0 if result.masks is None else int((result.boxes.cls == 0).sum())
+                                counts.add(path, row, instances,
+                                           100 * packed_count(packed) / (geometry['width'] * geometry['height']))
+                        with timer.stage('write wait', [path]):
+                            writer.submit(write_tracked, tracker, path, timer, path_to_predictions, row, path, packed,
+                                          mask_shape, mask_format, result if save_annotated else None, manifest,
+                                          pending[m], shape)
+    except KeyboardInterrupt:
+        print('stopping')
+    except BaseException:
+        failing = True
+        raise
+    finally:
+        stop.set()
+        thread.join()
+        pool.shutdown(wait=True)
+        close_outputs(writer, counts, manifest, failing=failing)
+    print_status(tracker, tiles, ready, watcher, latency_target_s)
+    print(timer.summary())
+    return timer.report()
+
+#----------------------------------------------------------------------------#
+# run
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    watch_folder(path_to_inbox, species_table, path_to_predictions, path_to_counts, path_to_manifest)
@@ -0,0 +1,384 @@
+#----------------------------------------------------------------------------#
+# load required modules
+#----------------------------------------------------------------------------#
+
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import socket
+import threading
+from species import load_species_table
+
+#----------------------------------------------------------------------------#
+# settings
+#----------------------------------------------------------------------------#
+
+path_to_queue = "/zenodo/CBarrasso/UAV_SegetalFlora/data/queue/"  # on the filesystem shared by the nodes
+task = 'predict'     # 'predict' tiles or 'evaluate' (species, plot, height) predictions
+path_to_tiles = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/"
+path_to_predictions = "/zenodo/CBarrasso/UAV_SegetalFlora/data/predictions/"
+path_to_masks = "/zenodo/CBarrasso/UAV_SegetalFlora/data/test_plots/masks/"
+path_to_output = "/zenodo/CBarrasso/UAV_SegetalFlora/data/YOLO_segmentation_accuracy.csv"
+path_to_manifest = path_to_predictions + "manifest.jsonl"  # one shard file per worker
+species_table = load_species_table()
+tiles_per_job = 32   # prediction jobs are chunks of tiles, so model loading is amortised
+mask_format = 'sfm'
+batch_size = 8
+lease_s = 600        # a lease not renewed for this long belongs to a crashed worker
+max_attempts = 3     # a job failing (or crashing its worker) this often is set aside in failed/
+idle_s = 30          # wait between polls while other workers still hold leases
+
+#----------------------------------------------------------------------------#
+# file-based work queue for several nodes sharing a filesystem, no broker:
+# every job is a JSON file in <queue>/todo/, claimed by atomically renaming
+# it into leased/ under the worker's name (only one rename can succeed),
+# then moved to done/ with its result or, after max_attempts, to failed/.
+# A worker renews its lease every lease_s / 4 while the job runs; leases
+# older than lease_s are put back into todo/ by any worker, so jobs of
+# crashed workers are picked up again. Ages are measured against the
+# filesystem clock (the change time of a file just touched), not the
+# clocks of the nodes.
+#----------------------------------------------------------------------------#
+
+STATES = ['todo', 'leased', 'done', 'failed']
+
+def job_id(*parts):
+    return re.sub('[^A-Za-z0-9_.-]', '_', '__'.join(parts))
+
+# short digest of the size and modification time of the inputs of a job,
+# part of its id, so a job whose inputs changed is a new job (missing inputs
+# count as a version too, the job fails as before)
+def file_version(*paths):
+    stats = [os.stat(path) if os.path.exists(path) else None for path in paths]
+    signature = ''.join(f'{stat.st_size}:{stat.st_mtime_ns};' if stat else '-;' for stat in stats)
+    return hashlib.sha256(signature.encode()).hexdigest()[:12]
+
+class WorkQueue:
+
+    def __init__(self, path, lease_s=600, max_attempts=3, worker=None):
+        self.path = path
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        for state in STATES + ['tmp']:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+        self.candidates = []
+
+    def _file(self, state, name):
+        return os.path.join(self.path, state, name)
+
+    def _write(self, state, name, record):
+        tmp = self._file('tmp', f'{name}.{self.worker}')
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp, self._file(state, name))
+
+    def _read(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def now(self):
+        clock = self._file('tmp', f'clock.{self.worker}')
+        with open(clock, 'a'):
+            pass
+        os.utime(clock)
+        return os.stat(clock).st_ctime
+
+    def names(self, state):
+        return os.listdir(os.path.join(self.path, state))
+
+    # jobs are dicts with a unique 'id'; ids already in any state are left
+    # alone, so filling again only adds new jobs. Fill from one process
+    # (see fill_once), a job added while it is being claimed would run twice
+    def add(self, jobs):
+        known = {name.split('@')[0] for state in STATES for name in self.names(state)}
+        added = 0
+        for job in jobs:
+            if job['id'] + '.json' not in known:
+                self._write('todo', job['id'] + '.json', dict(job, attempts=0))
+                added += 1
+        return added
+
+    # todo/, done/ and failed/ jobs not in ids, e.g. evaluations of
+    # predictions that have since been replaced; leased ones are left to
+    # finish and ignored by results(ids)
+    def prune(self, ids):
+        removed = 0
+        for state in ['todo', 'done', 'failed']:
+            for name in self.names(state):
+                if name[:-len('.json')] not in ids:
+                    try:
+                        os.remove(self._file(state, name))
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+    # every worker lists the jobs; the first to create the lock of this job
+    # set removes the jobs of earlier sets and queues the new ones, the
+    # others wait for its marker. The filling worker keeps the lock fresh
+    # like a lease; a lock older than lease_s (its worker died) is taken
+    # over by one of the waiting workers. Job ids carry the version of their
+    # inputs, so new tiles, weights or predictions give a new set and a
+    # rerun queues them
+    def fill_once(self, jobs):
+        ids = sorted(job['id'] for job in jobs)
+        marker = os.path.join(self.path, 'filled.' + hashlib.sha256('\n'.join(ids).encode()).hexdigest()[:16])
+        lock = marker + '.lock'
+        while not self._create(lock):
+            if os.path.exists(marker):
+                return 0
+            if not self._take_over(lock):
+                time.sleep(1)
+        with Heartbeat(self, lock):
+            removed = self.prune(set(ids))
+            if removed:
+                print(f'{self.worker}: removed {removed} jobs of an earlier job set')
+            added = self.add(jobs)
+            with open(marker, 'w') as f:
+                f.write(f'{added}\n')
+        return added
+
+    def _create(self, path):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    # an expired lock is renamed away, so only one worker removes it; a lock
+    # created anew in the meantime is put back
+    def _take_over(self, lock):
+        try:
+            stat = os.stat(lock)
+            if self.now() - stat.st_ctime < self.lease_s:
+                return False
+            grabbed = self._file('tmp', f'{os.path.basename(lock)}.expired.{self.worker}')
+            os.rename(lock, grabbed)
+        except FileNotFoundError:
+            return True
+        if os.stat(grabbed).st_ino != stat.st_ino:
+            os.rename(grabbed, lock)
+            return False
+        os.remove(grabbed)
+        print(f'{self.worker}: the worker filling the queue stopped, taking over')
+        return True
+
+    # (lease, job), or None when todo/ is empty; workers walk the sorted job
+    # list from different offsets so they rarely race for the same file
+    def claim(self):
+        for _ in range(2):
+            if not self.candidates:
+                self.reclaim()
+                names = sorted(self.names('todo'))
+                offset = zlib.crc32(self.worker.encode()) % len(names) if names else 0
+                self.candidates = names[offset:] + names[:offset]
+            while self.candidates:
+                name = self.candidates.pop(0)
+                lease = self._file('leased', f'{name}@{self.worker}')
+                try:
+                    os.rename(self._file('todo', name), lease)
+                except FileNotFoundError:
+                    continue  # claimed by another worker
+                os.utime(lease)
+                return lease, dict(self._read(lease), started=self.now())
+        return None
+
+    # False once the lease was reclaimed; the job still completes normally,
+    # outputs are written atomically and a second run gives the same result
+    def renew(self, lease):
+        try:
+            os.utime(lease)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, lease, job, result=None):
+        name = os.path.basename(lease).rsplit('@', 1)[0]
+        self._write('done', name, dict(job, worker=self.worker, finished=self.now(), result=result))
+        self._release(lease)
+
+    def fail(self, lease, job, error):
+        name = os.path.basename(lease).rsplit('@', 1)[0]
+        self._retry(name, dict(job, attempts=job['attempts'] + 1, error=repr(error)))
+        self._release(lease)
+
+    def _release(self, lease):
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            pass
+
+    def _retry(self, name, job):
+        job.pop('started', None)
+        self._write('failed' if job['attempts'] >= self.max_attempts else 'todo', name, job)
+
+    # expired leases back to todo/ (failed/ after max_attempts); the lease is
+    # first renamed away, so only one worker reclaims it
+    def reclaim(self):
+        now = self.now()
+        reclaimed = 0
+        for lease in self.names('leased'):
+            path = self._file('leased', lease)
+            try:
+                if now - os.stat(path).st_ctime < self.lease_s:
+                    continue
+                grabbed = self._file('tmp', f'{lease}.reclaimed.{self.worker}')
+                os.rename(path, grabbed)
+            except FileNotFoundError:
+                continue
+            name, worker = lease.rsplit('@', 1)
+            job = self._read(grabbed)
+            self._retry(name, dict(job, attempts=job['attempts'] + 1, error=f'lease of {worker} expired'))
+            os.remove(grabbed)
+            reclaimed += 1
+        if reclaimed:
+            print(f'{self.worker}: reclaimed {reclaimed} expired leases')
+        return reclaimed
+
+    def results(self, ids=None):
+        return [self._read(self._file('done', name)) for name in sorted(self.names('done'))
+                if ids is None or name[:-len('.json')] in ids]
+
+    # jobs per state and per worker, expired leases and, from the done jobs,
+    # the completion rate and time left at that rate
+    def progress(self):
+        now = self.now()
+        counts = {state: len(self.names(state)) for state in STATES}
+        expired = 0
+        for lease in self.names('leased'):
+            try:
+                expired += now - os.stat(self._file('leased', lease)).st_ctime >= self.lease_s
+            except FileNotFoundError:
+                pass
+        done = self.results()
+        workers = {}
+        for job in done:
+            worker = workers.setdefault(job['worker'], {'jobs': 0, 'busy_s': 0.0})
+            worker['jobs'] += 1
+            worker['busy_s'] += job['finished'] - job['started']
+        span = max(job['finished'] for job in done) - min(job['started'] for job in done) if done else 0
+        rate = len(done) / span if span else float('nan')
+        left = counts['todo'] + counts['leased']
+        return {'counts': counts, 'expired': expired, 'workers': workers, 'jobs_h': rate * 3600,
+                'eta_s': left / rate if done and rate else float('nan')}
+
+class Heartbeat:
+
+    def __init__(self, queue, lease):
+        self.queue = queue
+        self.lease = lease
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop.wait(self.queue.lease_s / 4):
+            if not self.queue.renew(self.lease):
+                print(f'{self.queue.worker}: lease {os.path.basename(self.lease)} was reclaimed')
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+# claims jobs until none are left in todo/ or leased/; a failing job is
+# recorded and retried (by this or another worker), not fatal
+def run_worker(queue, run_job, idle_s=30):
+    completed = 0
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            if not queue.names('leased'):
+                return completed
+            time.sleep(idle_s)  # leases of other workers may still expire
+            continue
+        lease, job = claimed
+        with Heartbeat(queue, lease):
+            try:
+                result = run_job(job)
+            except Exception as error:
+                print(f"{queue.worker}: {job['id']} failed: {error!r}")
+                queue.fail(lease, job, error)
+                continue
+        queue.complete(lease, job, result)
+        completed += 1
+
+def print_progress(queue):
+    progress = queue.progress()
+    counts = progress['counts']
+    total = sum(counts.values())
+    print(', '.join(f'{state} {count}' for state, count in counts.items())
+          + f" ({progress['expired']} leases expired), {counts['done'] / total if total else 0:.0%} done, "
+          f"{progress['jobs_h']:.1f} jobs/h, {progress['eta_s'] / 60:.0f} min left")
+    for worker, stats in sorted(progress['workers'].items()):
+        print(f"  {worker:<32}{stats['jobs']:6d} jobs {stats['busy_s']:10.1f} s busy")
+
+#----------------------------------------------------------------------------#
+# jobs: chunks of tiles for prediction, each worker recording into its own
+# manifest shard; single (species, plot, height) predictions for evaluation,
+# sorted so the heights of a plot tend to go to the worker that has its
+# ground truth cached
+#----------------------------------------------------------------------------#
+
+def prediction_jobs(tiles, species_table, tiles_per_job=32):
+    weights = [row['model'] for row in species_table]
+    return [{'id': job_id('tiles', f'{i // tiles_per_job:05d}', file_version(*tiles[i:i + tiles_per_job], *weights)),
+             'kind': 'predict', 'tiles': tiles[i:i + tiles_per_job]}
+            for i in range(0, len(tiles), tiles_per_job)]
+
+def accuracy_jobs(species_table, path_to_predictions, path_to_masks):
+    from segmentation_accuracy import evaluation_jobs
+    return [dict(job, id=job_id(job['species'], job['plot'], file_version(job['prediction'], job['ground_truth'])),
+                 kind='evaluate')
+            for job in evaluation_jobs(species_table, path_to_predictions, path_to_masks)]
+
+def run_job(job, worker):
+    if job['kind'] == 'predict':
+        from prediction_engine import predict_tiles
+        report = predict_tiles(job['tiles'], species_table, path_to_predictions, batch_size=batch_size,
+                               save_annotated=False, mask_format=mask_format,
+                               path_to_manifest=path_to_manifest, shard=worker)
+        return {'tiles': report['tiles'], 'elapsed_s': report['elapsed_s']}
+    from segmentation_accuracy import evaluate_jobs
+    return evaluate_jobs([{key: job[key] for key in ['species', 'prediction', 'ground_truth', 'plot', 'height']}])
+
+# accuracy table of the finished evaluation of jobs, as
+# segmentation_accuracy.py; jobs without a result (failed/) are reported
+def collect_accuracy(queue, species_table, jobs, path):
+    from segmentation_accuracy import write_accuracy
+    results = queue.results({job['id'] for job in jobs})
+    if len(results) < len(jobs):
+        print(f'{len(jobs) - len(results)} of {len(jobs)} evaluation jobs have no result (see failed/), '
+              f'{path} is incomplete')
+    rows = [row for job in results for row in job['result']]
+    order = {row['species']: i for i, row in enumerate(species_table)}
+    tmp = f'{path}.{queue.worker}.tmp'
+    write_accuracy(sorted(rows, key=lambda row: order[row['species']]), tmp)
+    os.replace(tmp, path)
+
+#----------------------------------------------------------------------------#
+# run: start the same script on any number of nodes
+#----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    queue = WorkQueue(os.path.join(path_to_queue, task), lease_s, max_attempts)
+    if task == 'predict':
+        from prediction_engine import list_tiles
+        jobs = prediction_jobs(list_tiles(path_to_tiles), species_table, tiles_per_job)
+    else:
+        jobs = accuracy_jobs(species_table, path_to_predictions, path_to_masks)
+    added = queue.fill_once(jobs)
+    if added:
+        print(f'{queue.worker}: queued {added} {task} jobs')
+    completed = run_worker(queue, lambda job: run_job(job, queue.worker), idle_s)
+    print(f'{queue.worker}: {completed} jobs completed')
+    print_progress(queue)
+    if task == 'evaluate' and not queue.names('todo') and not queue.names('leased'):
+        collect_accuracy(queue, species_table, jobs, path_to_output)
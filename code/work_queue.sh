@@ -0,0 +1,19 @@
+#!/bin/bash
+#SBATCH --job-name=work_queue
+#SBATCH --array=0-3 # one worker per array task, add tasks to scale out
+#SBATCH --ntasks=1
+#SBATCH --partition=alpha
+#SBATCH --cpus-per-task=12
+#SBATCH --time=0-02:00:00 # d-hh:mm:ss
+#SBATCH --gres=gpu:1
+#SBATCH --mem=20G # Memory per node
+#SBATCH --output=%A_%a.out # Standard output and error log
+
+cd /data/horse/ws/caba235b-my_environment 
+module load release/23.10 GCC/11.3.0 OpenMPI/4.1.4
+module load Python/3.10.4
+module load SciPy-bundle/2022.05 NCCL/2.12.12-CUDA-11.7.0 magma/2.6.2-CUDA-11.7.0
+source environment/bin/activate
+cd /home/h9/caba235b/scripts
+python work_queue.py       
+